@@ -4,12 +4,19 @@ Simple discord bot using the discord.py library
 
 from discord.ext import commands
 import discord
+import argparse
 import asyncio
+import importlib
 import json
+import os
 import sys
 import traceback
 import time
 
+from cogs.utils.metrics import Metrics
+from cogs.utils.outbox import Outbox
+from cogs.utils.webhook import ErrorReporter, post_discord
+
 description = """Hello! I am a bot made by /u/nickyu42"""
 command_prefix = '<>'
 
@@ -21,12 +28,284 @@ initial_extensions = [
     'cogs.blackjack_single'
 ]
 
+# Extensions that are only imported once one of their commands is used,
+# mapped to the names of their top level commands.
+# Cogs with listeners that have to see every event don't belong here,
+# they would miss everything before their first command.
+lazy_extensions = {
+    'cogs.reddit': ['reddit', 'stream', 'anime', 'manga', 'moe', 'maki'],
+}
+
+# False loads the lazy extensions at startup as well
+lazy_loading = True
+
+# Prometheus text file with the metrics, rewritten every metrics_interval seconds
+metrics_path = 'metrics.prom'
+metrics_interval = 60
+
+# events process_commands dispatches around every command, they time it
+command_events = ('command', 'command_completion', 'command_error')
+
+# messages not starting with one of these can't be commands, the mention prefix starts with <@
+command_starts = (command_prefix, '<@')
+
+
+class Route:
+    """Messages a listener wants to see
+
+    Each filter is a set the cog may change whenever it likes, or None to
+    accept anything. A message is delivered when it passes every filter.
+
+    :param channel_types: set of discord.ChannelType
+    :param channel_ids: set of channel ids
+    :param author_ids: set of author ids
+    """
+
+    def __init__(self, channel_types=None, channel_ids=None, author_ids=None):
+        self.channel_types = channel_types
+        self.channel_ids = channel_ids
+        self.author_ids = author_ids
+
+        self.delivered = 0
+        self.filtered = 0
+
+    def accepts(self, message):
+        return ((self.author_ids is None or message.author.id in self.author_ids) and
+                (self.channel_ids is None or message.channel.id in self.channel_ids) and
+                (self.channel_types is None or message.channel.type in self.channel_types))
+
+
+class MessageRouter:
+    """Routing table deciding which on_message listeners see a message
+
+    Listeners without a route get every message, like before.
+    """
+
+    def __init__(self):
+        # listener -> Route
+        self.routes = {}
+
+        self.stats = {'delivered': 0, 'filtered': 0, 'commands': 0, 'not_commands': 0}
+
+    def route(self, listener, **filters):
+        """Registers the messages a listener is interested in
+
+        :param listener: on_message method of a cog
+        :param filters: keyword arguments of Route
+        :return: the Route, to update its filters later on
+        """
+        route = Route(**filters)
+        self.routes[listener] = route
+        return route
+
+    def forget(self, cog):
+        """Drops the routes of a removed cog"""
+        for listener in tuple(self.routes):
+            if getattr(listener, '__self__', None) is cog:
+                del self.routes[listener]
+
+    def accepts(self, listener, message):
+        route = self.routes.get(listener)
+        if route is None:
+            self.stats['delivered'] += 1
+            return True
+
+        if route.accepts(message):
+            route.delivered += 1
+            self.stats['delivered'] += 1
+            return True
+
+        route.filtered += 1
+        self.stats['filtered'] += 1
+        return False
+
 
 class Bot(commands.Bot):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # extension -> (seconds spent importing, seconds spent in setup)
+        self.load_times = {}
+        self._import_times = {}
+
+        # command name -> extension of the placeholders of lazy extensions
+        self._lazy_commands = {}
+        self._lazy_lock = asyncio.Lock()
+
+        self.router = MessageRouter()
+
+        # (address, authkey) of the launcher's users.db writer when running as a shard
+        self.userbase = None
+
+        self.outbox = Outbox(self)
+        self.errors = ErrorReporter(loop=self.loop)
+        self.metrics = Metrics()
+        self.metrics_path = metrics_path
+        self._metrics_task = self.loop.create_task(self.metrics_task())
+
+    async def metrics_task(self):
+        while True:
+            await asyncio.sleep(metrics_interval)
+            self.write_metrics()
+
+    def write_metrics(self):
+        try:
+            self.metrics.write(self.metrics_path)
+        except OSError as e:
+            print('Failed to write metrics to {}\n{}: {}'.format(self.metrics_path, type(e).__name__, e))
+
+    async def _timed_request(self, method, coro):
+        start = time.perf_counter()
+        try:
+            return await coro
+        finally:
+            self.metrics.observe_request(method, time.perf_counter() - start)
+
+    # say and the other helpers end up in these, so every message the bot sends is timed
+
+    async def send_message(self, *args, **kwargs):
+        return await self._timed_request('send_message', super().send_message(*args, **kwargs))
+
+    async def send_file(self, *args, **kwargs):
+        return await self._timed_request('send_file', super().send_file(*args, **kwargs))
+
+    async def edit_message(self, *args, **kwargs):
+        return await self._timed_request('edit_message', super().edit_message(*args, **kwargs))
+
+    async def on_error(self, event, *args, **kwargs):
+        """Errors of listeners go to the error reporter, instead of a traceback each"""
+        self.errors.report(sys.exc_info()[1], 'in {}'.format(event))
+
+    def shard(self, shard_id, shard_count):
+        """Makes this bot connect as one of shard_count shards, has to happen before run"""
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.connection.shard_count = shard_count
+
+    def route_messages(self, listener, **filters):
+        """Shorthand for router.route, see MessageRouter"""
+        return self.router.route(listener, **filters)
+
+    def dispatch(self, event, *args, **kwargs):
+        """
+        Overridden version of dispatch from commands.Bot
+        which only hands messages to the listeners routed to them
+        and times commands, see Metrics.command_event
+        """
+        if event in command_events:
+            # placeholders of lazy extensions run the real command again, don't count it twice
+            if event != 'command' or args[0].name not in self._lazy_commands:
+                self.metrics.command_event(event, *args)
+
+        if event != 'message':
+            super().dispatch(event, *args, **kwargs)
+            return
+
+        # the bot's own on_message, which processes commands
+        discord.Client.dispatch(self, event, *args, **kwargs)
+
+        message = args[0]
+        for listener in self.extra_events.get('on_message', ()):
+            if self.router.accepts(listener, message):
+                asyncio.ensure_future(self._run_extra(listener, event, *args, **kwargs), loop=self.loop)
+
+    def remove_cog(self, name):
+        cog = self.cogs.get(name)
+        super().remove_cog(name)
+        self.router.forget(cog)
+
+    def _import(self, name):
+        """Imports the module of an extension and records how long that took"""
+        start = time.perf_counter()
+        importlib.import_module(name)
+        self._import_times[name] = time.perf_counter() - start
+
+    def load_extension(self, name):
+        """
+        Overridden version of load_extension from commands.Bot
+        which times the import and setup of the extension
+        and replaces its lazy placeholders with the real commands
+        """
+        if name in self.extensions:
+            return
+
+        if name not in sys.modules:
+            self._import(name)
+
+        start = time.perf_counter()
+        self._remove_lazy_commands(name)
+
+        try:
+            super().load_extension(name)
+        except Exception:
+            self._add_lazy_commands(name)
+            raise
+
+        self.load_times[name] = (self._import_times.pop(name, 0.0), time.perf_counter() - start)
+
+    def unload_extension(self, name):
+        """Unloading a lazy extension makes it lazy again"""
+        super().unload_extension(name)
+        self._add_lazy_commands(name)
+
+    def _lazy_command(self, extension, name):
+        """:return: placeholder command that loads extension and runs the message again"""
+
+        async def load_and_invoke(ctx):
+            await self.load_lazy_extension(extension)
+
+            # the real command has replaced this one by now
+            await self.process_commands(ctx.message)
+
+        return commands.command(name=name, pass_context=True, hidden=True,
+                                help='Loads {}'.format(extension))(load_and_invoke)
+
+    def _add_lazy_commands(self, extension):
+        if not lazy_loading:
+            return
+
+        for name in lazy_extensions.get(extension, ()):
+            if name not in self.commands:
+                self.add_command(self._lazy_command(extension, name))
+                self._lazy_commands[name] = extension
+
+    def _remove_lazy_commands(self, extension):
+        for name, owner in tuple(self._lazy_commands.items()):
+            if owner == extension:
+                self.remove_command(name)
+                del self._lazy_commands[name]
+
+    def waiting_extensions(self):
+        """:return: set of the lazy extensions that haven't been loaded yet"""
+        return set(self._lazy_commands.values())
+
+    async def load_lazy_extension(self, name):
+        """Loads an extension without blocking the event loop on its imports"""
+        async with self._lazy_lock:
+            if name in self.extensions:
+                return
+
+            if name not in sys.modules:
+                await self.loop.run_in_executor(None, self._import, name)
+
+            print('Loading lazy extension', name)
+            self.load_extension(name)
+
     def _load_extensions(self):
-        """Tries to load all initial extensions"""
-        for extension in initial_extensions:
+        """Tries to load all initial extensions, and registers the lazy ones"""
+        start = time.perf_counter()
+        if lazy_loading:
+            # lazy extensions only get their placeholders, even when they are initial extensions too
+            extensions = [e for e in initial_extensions if e not in lazy_extensions]
+
+            for extension in lazy_extensions:
+                self._add_lazy_commands(extension)
+        else:
+            extensions = list(initial_extensions)
+            extensions.extend(e for e in lazy_extensions if e not in extensions)
+
+        for extension in extensions:
             try:
                 print('Loading extension', extension, end=' - ')
                 self.load_extension(extension)
@@ -35,6 +314,22 @@ class Bot(commands.Bot):
                 exc = '{}: {}'.format(type(e).__name__, e)
                 print('Failed to load extension {}\n{}'.format(extension, exc))
 
+        print(self.startup_report(time.perf_counter() - start))
+
+    def startup_report(self, total):
+        """:return: table of the time every loaded extension took, slowest first"""
+        lines = ['{:<24}{:>12}{:>12}'.format('extension', 'import ms', 'setup ms')]
+
+        for name, (imported, setup) in sorted(self.load_times.items(), key=lambda item: -sum(item[1])):
+            lines.append('{:<24}{:>12.1f}{:>12.1f}'.format(name, imported * 1000, setup * 1000))
+
+        lazy = sorted(self.waiting_extensions())
+        if lazy:
+            lines.append('Lazy: ' + ', '.join(lazy))
+
+        lines.append('Started {} extensions in {:.1f} ms'.format(len(self.extensions), total * 1000))
+        return '\n'.join(lines)
+
     def _unload_extensions(self):
         """Tries to unload all active extensions"""
         for extension in tuple(self.extensions):
@@ -79,6 +374,17 @@ class Bot(commands.Bot):
                 pass
 
         finally:
+            # make sure cogs get to clean up, e.g. Currency flushing its balances,
+            # even when the bot stopped because of something else than ctrl-c
+            self._unload_extensions()
+            self._remove_cogs()
+            self.write_metrics()
+
+            try:
+                self.loop.run_until_complete(self.errors.close())
+            except Exception as e:
+                print('Failed to close the error reporter: {}: {}'.format(type(e).__name__, e))
+
             self.loop.close()
 
 
@@ -97,11 +403,18 @@ async def on_ready():
 
 @bot.event
 async def on_command_error(exception, ctx):
-    print('[{0.author.name} | {0.timestamp}] {0.content}'.format(ctx.message))
-    traceback.print_exception(type(exception), exception, exception.__traceback__, file=sys.stderr)
+    context = '[{0.author.name} | {0.timestamp}] {0.content}'.format(ctx.message)
+
+    # anything else is a wrong argument, a failed check or the like, not a bug
+    if isinstance(exception, commands.CommandInvokeError):
+        bot.errors.report(exception, context)
+    else:
+        print(context, '-', type(exception).__name__, exception)
 
-    fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
-    await bot.send_message(ctx.message.channel, fmt.format(type(exception).__name__, exception))
+    # when a service is down every command fails, don't answer each one of them
+    if bot.errors.should_reply(ctx.message.channel.id):
+        fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
+        await bot.send_message(ctx.message.channel, fmt.format(type(exception).__name__, exception))
 
 
 @bot.event
@@ -109,6 +422,11 @@ async def on_message(message):
     if message.author.bot: 
         return
 
+    if not message.content.startswith(command_starts):
+        bot.router.stats['not_commands'] += 1
+        return
+
+    bot.router.stats['commands'] += 1
     await bot.process_commands(message)
 
 
@@ -117,14 +435,49 @@ def load_credentials():
         return json.load(f)
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description='Runs the bot, or a launcher running it as several shards')
+    parser.add_argument('--shards', type=int, help='run a launcher starting and supervising this many shards')
+
+    # used by the launcher to start the shards
+    parser.add_argument('--shard-id', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--shard-count', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--userbase', help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
 if __name__ == '__main__':
+    args = parse_args()
+
+    if args.shards:
+        import launcher
+        launcher.Launcher(args.shards).run()
+        sys.exit()
+
+    if args.shard_id is not None:
+        import launcher
+        bot.shard(args.shard_id, args.shard_count)
+        bot.metrics_path = launcher.shard_metrics_path.format(args.shard_id)
+
+        host, port = args.userbase.rsplit(':', 1)
+        bot.userbase = ((host, int(port)), bytes.fromhex(os.environ['USERBASE_AUTHKEY']))
+
     credentials = load_credentials()
+    webhook = credentials.get('WEBHOOK')
+
+    bot.errors.url = webhook
+    if args.shard_id is not None:
+        bot.errors.name += ' (shard {})'.format(args.shard_id)
+
     try:
         bot.run(credentials['TOKEN'])
     except Exception as e:
-        import cogs.utils.webhook as wh
-        print(wh.post_discord('Waifu bot notifier', str(e), credentials['WEBHOOK']))
+        traceback.print_exc()
+        if webhook:
+            print(post_discord(bot.errors.name, '{}: {}'.format(type(e).__name__, e), webhook))
     finally:
-        import cogs.utils.webhook as wh
-        wh.post_discord('Waifu bot notifier', 'Server closed', credentials['WEBHOOK'])
+        # the event loop is closed by now, so these are posted synchronously
+        if webhook:
+            post_discord(bot.errors.name, 'Server closed', webhook)
         sys.exit()
@@ -74,7 +74,7 @@ class Admin:
     @commands.command(hidden=True)
     @check.is_owner()
     async def status(self):
-        """Displays a page with a table of all modules"""
+        """Displays a page with a table of all modules and how long they took to load"""
 
         all_modules = glob.glob('./cogs/*.py')
         # remove file extension and directory and sort alphabetically
@@ -83,20 +83,67 @@ class Admin:
         active_modules = list(self.bot.extensions.keys())
         active_modules = [m[5:] for m in active_modules]
 
-        header = 'Module' + ' '*14 + '|' + ' Status' + '\n' 
+        lazy_modules = [m[5:] for m in self.bot.waiting_extensions()]
+
+        header = 'Module' + ' '*14 + '|' + ' Status' + ' |' + ' Load ms' + '\n' 
 
         lines = []
         for module in all_modules:
+            load_ms = ''
             if module in active_modules:
                 status = '\N{CHECK MARK}'
+                load_ms = '{:.1f}'.format(sum(self.bot.load_times.get('cogs.' + module, ())) * 1000)
+            elif module in lazy_modules:
+                status = 'lazy'
             else:
                 status = '\N{BALLOT X}'
-            lines.append('{:20}|{:>3}\n'.format(module, status))
+            lines.append('{:20}|{:>7} |{:>8}\n'.format(module, status, load_ms))
 
         table = header + ''.join(lines)
 
         await self.bot.say(convert_to_codeblock(table))
 
+    @commands.command(hidden=True)
+    @check.is_owner()
+    async def routes(self):
+        """Displays how many messages each routed listener got and was spared"""
+        stats = self.bot.router.stats
+        lines = ['commands {commands}, other messages {not_commands}'.format(**stats),
+                 'listeners: delivered {delivered}, filtered {filtered}'.format(**stats),
+                 '{:<32}{:>10}{:>10}'.format('listener', 'delivered', 'filtered')]
+
+        for listener, route in self.bot.router.routes.items():
+            name = '{}.{}'.format(type(listener.__self__).__name__, listener.__name__)
+            lines.append('{:<32}{:>10}{:>10}'.format(name, route.delivered, route.filtered))
+
+        await self.bot.say(convert_to_codeblock('\n'.join(lines)))
+
+    @commands.command(hidden=True)
+    @check.is_owner()
+    async def metrics(self):
+        """Displays call counts, errors and latency percentiles of every command used"""
+        metrics = self.bot.metrics
+        fmt = '{:<20}{:>7}{:>7}{:>9}{:>9}{:>9}'
+        lines = [fmt.format('command', 'calls', 'errors', 'p50 ms', 'p95 ms', 'p99 ms')]
+
+        def row(name, calls, errors, histogram):
+            quantiles = [histogram.quantile(q) * 1000 for q in (0.5, 0.95, 0.99)]
+            return fmt.format(name, calls, errors, *('{:.1f}'.format(q) for q in quantiles))
+
+        for name, stats in sorted(metrics.commands.items()):
+            lines.append(row(name, stats.calls, stats.errors, stats.latency))
+
+        lines.append('')
+        lines.append(fmt.format('discord api', 'calls', '', 'p50 ms', 'p95 ms', 'p99 ms'))
+        for method, histogram in sorted(metrics.requests.items()):
+            lines.append(row(method, histogram.count, '', histogram))
+
+        lines.append('outbox: {queued} messages queued, sent as {sent}, {failed} failed'.format(**self.bot.outbox.stats))
+        lines.append('errors: {reported} reported, {digests} digests posted, {failed_digests} failed, '
+                     '{throttled_replies} replies throttled'.format(**self.bot.errors.stats))
+
+        await self.bot.say(convert_to_codeblock('\n'.join(lines)))
+
 
 def setup(bot):
     bot.add_cog(Admin(bot))
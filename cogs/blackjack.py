@@ -1,6 +1,7 @@
 import discord 
 from discord.ext import commands
 import random as rnd
+import asyncio
 
 
 GAME_RULES = """\
@@ -233,16 +234,20 @@ class Game():
         self.current_plr = next(self.player_iterator)
 
         dealer = get_dealer(self.players[-1])
+        sent = []
         
         for player in self.players:
             if player.sort is not 'dealer':
                 player.hand = self.create_hand()
 
-                await self.bot.send_message(player.author, "A new game has started\nDealer's hand:\n" + dealer)
-                await self.bot.send_message(player.author, "Your hand: \n" + get_cards(player))
+                # the outbox merges these into one message per player
+                sent.append(self.bot.outbox.send(player.author, "A new game has started\nDealer's hand:\n" + dealer))
+                sent.append(self.bot.outbox.send(player.author, "Your hand: \n" + get_cards(player)))
 
                 current_player_msg = "It's {} turn".format(self.current_plr.name)
-                await self.bot.send_message(self.current_plr.author, current_player_msg)
+                sent.append(self.bot.outbox.send(self.current_plr.author, current_player_msg))
+
+        await asyncio.gather(*sent)
 
 
     def get_highest_hand(self):
@@ -279,9 +284,9 @@ class Game():
 
                 dealer_hand = get_cards(self.current_plr)
 
-                # generate message to send
+                # generate message to send, it is merged with the first message of the next game
                 message_to_send = '\n'.join(["Dealer's hand: ", dealer_hand, banner])
-                await self.bot.send_message(player.author, message_to_send)
+                self.bot.outbox.send(player.author, message_to_send)
 
         await self.start_turn()
 
@@ -302,7 +307,7 @@ class Game():
 
 
         elif cmd.lower() == 'pass':
-            await self.bot.send_message(self.current_plr.author, 'You have passed')
+            self.bot.outbox.send(self.current_plr.author, 'You have passed')
 
             # move on to next player
             self.current_plr = next(self.player_iterator)
@@ -320,6 +325,10 @@ class Blackjack():
         # dict with all players waiting to play with discord id's
         self.lobby = []
 
+        # games are played in DMs, only messages of players in the game reach on_message
+        self.route = bot.route_messages(self.on_message, channel_types={discord.ChannelType.private},
+                                        author_ids=set())
+
 
     @commands.group(pass_context=True)
     async def blackjack(self, ctx):
@@ -353,6 +362,7 @@ class Blackjack():
         if not self.lobby and self.ongoing_game: 
             del self.ongoing_game
             self.ongoing_game = None
+            self.route.author_ids.clear()
 
 
     @blackjack.command()
@@ -363,6 +373,7 @@ class Blackjack():
             return 
 
         self.ongoing_game = Game(self.lobby, self.bot)
+        self.route.author_ids.update(player.id for player in self.lobby)
 
         await self.ongoing_game.start_turn()
 
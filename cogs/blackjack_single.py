@@ -232,7 +232,7 @@ class Game:
 
         # generate message to send
         to_send = '\n'.join(["Dealer's hand: ", dealer_hand, result, hand_values])
-        await self.bot.send_message(self.player.author, to_send)
+        await self.bot.outbox.send(self.player.author, to_send)
 
         self.is_done = True
 
@@ -251,7 +251,8 @@ class Game:
             await self.bot.send_message(self.player.author, to_send)
 
         elif cmd.lower() == 'pass':
-            await self.bot.send_message(self.player.author, 'You have passed')
+            # merged with the result end_turn sends
+            self.bot.outbox.send(self.player.author, 'You have passed')
             await self.end_turn()
 
 
@@ -261,6 +262,10 @@ class Blackjack:
         self.bot = bot
         self.ongoing_games = []
 
+        # games are played in DMs, only messages of players reach on_message
+        self.route = bot.route_messages(self.on_message, channel_types={discord.ChannelType.private},
+                                        author_ids=set())
+
     @commands.group(pass_context=True, name='bj')
     async def blackjack(self, ctx):
         name = ctx.message.author.name
@@ -272,21 +277,24 @@ class Blackjack:
                 return
 
         self.ongoing_games.append(Game(ctx.message.author, self.bot))
+        self.route.author_ids.add(ctx.message.author.id)
 
         await self.ongoing_games[-1].start_turn()
 
     async def on_message(self, message):
         """
-        Method checks for messages when there is an ongoing game
-        and parses them to the Game object 
+        Method parses messages of a player to their Game object,
+        only DMs of players with an ongoing game get here
         """
-        if self.ongoing_games:
-            for game in self.ongoing_games:
-                if not game.is_done:
-                    await game.process_command(message)
-                else:
-                    # remove the game from the list if it's done
+        for game in self.ongoing_games:
+            if game.player.author.id == message.author.id:
+                await game.process_command(message)
+
+                # remove the game from the list if it's done
+                if game.is_done:
                     self.ongoing_games.remove(game)
+                    self.route.author_ids.discard(message.author.id)
+                return
 
 
 def setup(bot):
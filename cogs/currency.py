@@ -1,15 +1,23 @@
 import discord
 from discord.ext import commands 
+import asyncio
 import sqlite3
+import time
 
 from .utils import check
+from .utils.formatting import convert_to_codeblock
+from .utils import userbase
+from .utils.balances import BalanceCache
+from .utils.database import Database, RemoteDatabase
+from .utils.directory import MemberDirectory
+from .utils.leaderboard import Leaderboard
 
 
-def change_bank(ctx, name: str, amount: int, modifier: str, warning=False):
+async def change_bank(ctx, member_id: str, amount: int, modifier: str, warning=False):
     """Global method or changing someones bank value
 
     :param ctx: commands.Context class
-    :param name: str name of user to change bank
+    :param member_id: str discord id of user to change bank
     :param amount: str amount of money to add or remove
     :param modifier: str either + or -
     :param warning: bool To raise an exception if the user doesn't have enough money or not
@@ -20,13 +28,12 @@ def change_bank(ctx, name: str, amount: int, modifier: str, warning=False):
 
     obj = ctx.bot.cogs['Currency']
 
-    if warning and obj.in_bank(name) - amount < 0:
-        raise ValueError("{} does not have enough money".format(name))
-
     if modifier is '+':
-        obj.add_money(name, amount)
+        await obj.transfer(None, member_id, amount)
+    elif warning:
+        await obj.transfer(member_id, None, amount)
     else:
-        obj.remove_money(name, amount)
+        await obj.remove_money(member_id, amount)
 
 
 class Currency:
@@ -36,9 +43,9 @@ class Currency:
     +---------+-----------------------------------+
     | Column  |           Description             |
     +---------+-----------------------------------+
-    |  id     | Discord ID: INT                   |
+    |  id     | Discord ID: INT PRIMARY KEY       |
     +---------+-----------------------------------+
-    |  name   | Discord name: STRING              |
+    |  name   | Discord name: STRING, indexed     |
     +---------+-----------------------------------+
     |  money  | Amount of money: INT              |
     +---------+-----------------------------------+
@@ -46,47 +53,70 @@ class Currency:
     |         | format                            |
     +---------+-----------------------------------+
 
+    Existing name keyed databases are migrated on load, see utils.userbase
+
+    Balances are served from a write-behind cache, changes reach users.db
+    every _flush_interval seconds or once _flush_threshold users changed
+
+    When sharded, users.db is reached through the launcher's single writer,
+    balances are written through and the directory and leaderboard are
+    reloaded every _refresh_interval seconds to pick up the other shards' changes
     """
-    _columns = ['id', 'name', 'money', 'daily']
-    # TODO: add daily to table Users
+    _columns = userbase.COLUMNS
+    _flush_interval = 5
+    _flush_threshold = 100
+    _import_chunk = 1000
+    _progress_interval = 2
+    _refresh_interval = 60
 
     def __init__(self, bot):
         self.bot = bot
-        self.con = sqlite3.connect('users.db')
-        self.cur = self.con.cursor()
-
-    def __unload(self):
-        if self.con:
-            self.con.close()
-
-    def _add_member(self, discord_id, name):
-        """Add a new member to the user base
-        :param discord_id: discord user.id INT
-        :param name: discord user name
+        shared = bot.userbase is not None
 
-        :return: raises exception on failure
-        """
-        fs = "INSERT INTO Users (Id, Name) VALUES ({0}, '{1}')"
-        fs = fs.format(discord_id, name)
-
-        try:
-            self.cur.execute(fs)
-
-        except sqlite3.IntegrityError as e:
-            # rollback changes if error occurs
-            if self.con:
-                self.con.rollback()
+        if shared:
+            self.db = RemoteDatabase(*bot.userbase, loop=bot.loop)
+        else:
+            self.db = Database('users.db', loop=bot.loop)
 
-            raise e
+        self.db.run_sync(userbase.enable_wal)
+        self.db.run_sync(userbase.create_schema)
 
-    @property
-    def _members(self):
-        self.cur.execute('SELECT name FROM Users')
-        members = [t[0] for t in self.cur.fetchall()]
+        self.directory = MemberDirectory(self.db.run_sync(userbase.get_directory))
+        self.leaderboard = Leaderboard(self.db.run_sync(userbase.get_balances))
+        self.balances = BalanceCache(self.db, self._flush_interval, self._flush_threshold,
+                                     on_change=self.leaderboard.update, write_through=shared)
 
-        return members
+        self._refresh = bot.loop.create_task(self._refresh_task()) if shared else None
 
-    def get_rows(self, column, value):
+    def __unload(self):
+        if self._refresh is not None:
+            self._refresh.cancel()
+
+        if self.db:
+            self.balances.close()
+            self.db.close()
+
+    async def _refresh_task(self):
+        while True:
+            await asyncio.sleep(self._refresh_interval)
+
+            try:
+                self.directory.load(await self.db.run(userbase.get_directory))
+                self.leaderboard.load(await self.db.run(userbase.get_balances))
+            except Exception as e:
+                print('Failed to refresh the user base: {}'.format(e))
+
+    def _cached(self, row):
+        """Converts a Users row into a dict, with the money taken from the cache"""
+        data = dict(zip(self._columns, row))
+        data['money'] = self.balances.balances.get(data['id'], data['money'])
+        return data
+
+    def get_members(self):
+        """:return: list of names of everyone in the user base"""
+        return list(self.directory.names.values())
+
+    async def get_rows(self, column, value):
         """Grabs all rows where column=value
 
         :param column: selector column
@@ -99,68 +129,52 @@ class Currency:
         if column not in self._columns:
             return []
 
-        cmd = 'SELECT * FROM Users where {0}=({1})'
-
-        # add quotation marks if value is a string
-        if type(value) is str:
-            self.cur.execute(cmd.format(column, "'" + value + "'"))
-        else:
-            self.cur.execute(cmd.format(column, value))
-
-        rows = self.cur.fetchall()
+        rows = await self.db.run(userbase.get_rows, column, value)
 
         if rows:
-            all_rows = [dict(zip(self._columns, row)) for row in rows]
+            all_rows = [self._cached(row) for row in rows]
             return all_rows
         else:
             return []
 
-    def get_data(self, name):
+    async def get_data(self, member_id):
         """Grabs all values from given user
 
+        :param member_id: discord member id
         :return: dict with columns as keys with values
                  return empty list does not exist
         """
-        cmd = "SELECT * FROM Users where name='{}'"
-        self.cur.execute(cmd.format(name))
-
-        row = self.cur.fetchone()
+        row = await self.db.run(userbase.get_user, member_id)
 
         if row:
-            return dict(zip(self._columns, row))
+            return self._cached(row)
         else:
             return []
 
-    def in_bank(self, name):
+    async def in_bank(self, member_id):
         """Get how much money is left
 
-        :param name: discord member name
-        :return: int money left
+        :param member_id: discord member id
+        :return: int money left, None if the member isn't in the user base
         """
-        self.cur.execute("SELECT money FROM Users WHERE name='{}'".format(name))
-        return self.cur.fetchone()[0]
+        return await self.balances.get(member_id)
 
-    def add_money(self, name, amount):
-        in_bank = self.in_bank(name)
-        new_value = in_bank + int(amount)
+    async def add_money(self, member_id, amount):
+        await self.balances.add(member_id, amount)
 
-        to_execute = "UPDATE Users SET money={0} WHERE name='{1}'".format(new_value, name)
-        self.cur.execute(to_execute)
+    async def remove_money(self, member_id, amount):
+        await self.balances.remove(member_id, amount)
 
-        self.con.commit()
+    async def transfer(self, from_id, to_id, amount):
+        """Atomically moves money from one user to another
 
-    def remove_money(self, name, amount):
-        in_bank = self.in_bank(name)
+        :param from_id: discord id of the payer, None if the bank pays
+        :param to_id: discord id of the receiver, None if the bank receives
+        :param amount: amount of money to move
 
-        if in_bank - amount < 0:
-            new_value = 0
-        else:
-            new_value = in_bank - int(amount)
-
-        to_execute = "UPDATE Users SET money={0} WHERE name='{1}'".format(new_value, name)
-        self.cur.execute(to_execute)
-
-        self.con.commit()
+        :return: raises ValueError when the payer doesn't have enough money
+        """
+        await self.balances.transfer(from_id, to_id, amount)
 
     @commands.group(name='db')
     async def database(self):
@@ -170,22 +184,46 @@ class Currency:
     @check.is_owner()
     async def execute(self, *, cmd: str):
         """Method executes given sql command"""
+        # the command might touch balances, so write ours first and reload afterwards
+        await self.balances.flush()
+
         try:
-            self.cur.execute(cmd)
-            self.con.commit()
+            await self.db.run(userbase.execute, cmd)
             await self.bot.say('\N{CHECK MARK}')
         except sqlite3.Error as e:
-            # if error occurs revert changes
-            if self.con:
-                self.con.rollback()
-
             await self.bot.say('{}: {}'.format(type(e).__name__, e))
+        finally:
+            self.balances.invalidate()
+            self.directory.load(await self.db.run(userbase.get_directory))
+            self.leaderboard.load(await self.db.run(userbase.get_balances))
+
+    @database.command(hidden=True)
+    @check.is_owner()
+    async def stats(self):
+        """Shows balance cache and flush counters"""
+        stats = self.balances.stats
+        lookups = stats['hits'] + stats['misses']
+        flushes = stats['flushes'] or 1
+
+        lines = [
+            'Cached users   {}'.format(len(self.balances.balances)),
+            'Dirty users    {}'.format(len(self.balances.dirty)),
+            'Cache hits     {} / {}'.format(stats['hits'], lookups),
+            'Flushes        {}'.format(stats['flushes']),
+            'Rows flushed   {} (avg {:.1f}, max {})'.format(stats['flushed_rows'],
+                                                          stats['flushed_rows'] / flushes,
+                                                          stats['max_flush_size']),
+            'Flush latency  avg {:.2f}ms, max {:.2f}ms'.format(stats['flush_time'] / flushes * 1000,
+                                                              stats['max_flush_time'] * 1000),
+        ]
+
+        await self.bot.say(convert_to_codeblock('\n'.join(lines)))
 
     @database.command(hidden=True)
     @check.is_owner()
     async def members(self):
         """Return all members in the user base"""
-        await self.bot.say('\n'.join(self._members))
+        await self.bot.say('\n'.join(self.get_members()))
 
     @database.command(pass_context=True, hidden=True)
     @check.is_owner()
@@ -197,21 +235,45 @@ class Currency:
         if message.channel.is_private:
             return
 
-        self.cur.execute('SELECT Name FROM Users')
-        existing_members = [n[0] for n in self.cur.fetchall()]
+        # members that are already in the user base under the same name can be skipped right away
+        humans = [m for m in message.server.members if not m.bot]
+        members = [(m.id, m.name) for m in humans if self.directory.name(m.id) != m.name]
+        chunks = [members[i:i + self._import_chunk] for i in range(0, len(members), self._import_chunk)]
+
+        status = await self.bot.say('Adding {} members to the user base..'.format(len(members)))
+        inserted = renamed = 0
+        last_edit = time.monotonic()
+
+        for done, chunk in enumerate(chunks, 1):
+            try:
+                added, changed = await self.db.run(userbase.add_members, chunk)
+            except sqlite3.Error as e:
+                await self.bot.edit_message(status, '{}: Failed after adding {} members'.format(e, inserted))
+                return
+
+            inserted += added
+            renamed += changed
 
-        for member in message.server.members:
-            name = member.name
+            for discord_id, name in chunk:
+                if discord_id not in self.directory:
+                    self.leaderboard.update(discord_id, 0)
 
-            if name not in existing_members and not member.bot:
-                try:
-                    self._add_member(member.id, name)
-                    await self.bot.say('Successfully added {} to the user base'.format(name))
+                self.directory.add(discord_id, name)
 
-                except Exception as e:
-                    await self.bot.say('{}: Failed to add {} to the user base'.format(e, name))
+            # edits share the channel's rate limit, so don't update more often than needed
+            if done < len(chunks) and time.monotonic() - last_edit > self._progress_interval:
+                last_edit = time.monotonic()
+                progress = 'Adding members to the user base.. {}/{}'.format(done * self._import_chunk, len(members))
+                await self.bot.edit_message(status, progress)
 
-        self.con.commit()
+        summary = 'Added {} new members to the user base, updated {} names, {} were already in it'
+        await self.bot.edit_message(status, summary.format(inserted, renamed, len(humans) - inserted))
+
+    async def on_member_update(self, before, after):
+        """Keeps names in the user base up to date"""
+        if before.name != after.name and after.id in self.directory:
+            await self.db.run(userbase.rename_member, after.id, after.name)
+            self.directory.add(after.id, after.name)
 
     @commands.command(pass_context=True)
     async def give(self, ctx, amount: int, member: discord.Member = None):
@@ -224,34 +286,73 @@ class Currency:
         :param member: discord member class, receiver
         """
 
-        giver = ctx.message.author.name
-        receiver = member.name
+        giver = ctx.message.author
+        receiver = member.id
         member_mention = '<@{}>'.format(member.id)
 
-        if receiver not in self._members:
+        if receiver not in self.directory:
             await self.bot.say('{} is not in the user base, or does not exist'.format(member))
             return
 
+        if amount <= 0:
+            await self.bot.say('You can only give a positive amount')
+            return
+
         # if giver is owner, no money is subtracted
         if check.is_owner_check(ctx.message):
-            self.add_money(receiver, amount)
-            await self.bot.say("{} has received {} from {}".format(member_mention, amount, giver))
+            await self.transfer(None, receiver, amount)
+            await self.bot.say("{} has received {} from {}".format(member_mention, amount, giver.name))
         else:
-            in_bank = self.in_bank(giver)
-            if in_bank - int(amount) < 0:
+            try:
+                await self.transfer(giver.id, receiver, amount)
+            except ValueError:
                 await self.bot.say("You don't have enough money")
             else:
-                self.remove_money(giver, amount)
-                self.add_money(receiver, amount)
-                await self.bot.say("{}, has received {} from {}".format(member_mention, amount, giver))
+                await self.bot.say("{}, has received {} from {}".format(member_mention, amount, giver.name))
+
+    @commands.command()
+    async def top(self, n: int = 10):
+        """Shows the richest members of the user base
+
+        :param n: amount of members to show, at most 25
+        """
+        n = max(1, min(n, 25))
+
+        lines = []
+        for place, (discord_id, money) in enumerate(self.leaderboard.top(n), 1):
+            # the directory can lag behind the balances, fall back to the id
+            name = self.directory.name(discord_id) or discord_id
+            lines.append('{:>3}. {:<24} {}'.format(place, name, money))
+
+        if lines:
+            await self.bot.say(convert_to_codeblock('\n'.join(lines)))
+        else:
+            await self.bot.say('The user base is empty')
+
+    @commands.command(pass_context=True)
+    async def rank(self, ctx, member: discord.Member = None):
+        """Tells where the invoker, or the given member, stands on the leaderboard"""
+        if member is None:
+            member = ctx.message.author
+
+        place = self.leaderboard.rank(member.id)
+
+        if place is None:
+            await self.bot.say('{} is not in the user base'.format(member.name))
+        else:
+            fmt = '{} is ranked #{} of {} with {}'
+            await self.bot.say(fmt.format(member.name, place, len(self.leaderboard), self.leaderboard.money[member.id]))
 
     @commands.command(pass_context=True, name='$')
     async def _get_money(self, ctx):
         """Tells the invoker how much money he has in bank"""
         member_mention = '<@{}>'.format(ctx.message.author.id)
-        in_bank = self.in_bank(ctx.message.author.name)
+        in_bank = await self.in_bank(ctx.message.author.id)
 
-        await self.bot.say('{} you have {}'.format(member_mention, in_bank))
+        if in_bank is None:
+            await self.bot.say('{} you are not in the user base'.format(member_mention))
+        else:
+            await self.bot.say('{} you have {}'.format(member_mention, in_bank))
 
 
 def setup(bot):
@@ -22,14 +22,14 @@ class Gambling:
         :param ctx: commands.Context class
         :param bet: amount of money to bet
         """
-        member = ctx.message.author.name
+        member = ctx.message.author.id
 
         if bet > 100:
             await self.bot.say('You cannot bet over 100')
             return
 
         try:
-            change_bank(ctx, member, bet, '-', warning=True)
+            await change_bank(ctx, member, bet, '-', warning=True)
         except ValueError:
             await self.bot.say("You don't have enough money")
             return
@@ -39,14 +39,15 @@ class Gambling:
 
         if random.randint(1, 6) == 1:
             bet = int(ceil(bet * 3))
-            await self.bot.edit_message(msg, 'BANG!\N{PISTOL}')
-            await self.bot.say('Sadly, your day ended with a bullet in your head, you lose -{}'.format(bet))
-            change_bank(ctx, member, bet, '-')
+            # the outcome goes in the same message, a follow up would cost another request
+            await self.bot.edit_message(msg, 'BANG!\N{PISTOL}\n'
+                                        'Sadly, your day ended with a bullet in your head, you lose -{}'.format(bet))
+            await change_bank(ctx, member, bet, '-')
         else:
             to_add = int(ceil(bet * 1.2))
-            await self.bot.edit_message(msg, 'CLICK!\N{PISTOL}')
-            await self.bot.say('Congratz on surviving, you get +{}'.format(to_add - bet))
-            change_bank(ctx, member, to_add, '+')
+            await self.bot.edit_message(msg, 'CLICK!\N{PISTOL}\n'
+                                        'Congratz on surviving, you get +{}'.format(to_add - bet))
+            await change_bank(ctx, member, to_add, '+')
 
 
 def setup(bot):
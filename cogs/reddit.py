@@ -1,82 +1,502 @@
 import discord
 from discord.ext import commands
 import praw
+import asyncio
+import functools
 import random as rnd
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils import check
+from .utils.formatting import convert_to_codeblock
+
+
+MOE_SUBREDDITS = ['headpats', 'animeponytails', 'cutelittlefangs']
 
 
 class Stream:
     """Represents a submission stream from a
     given subreddit
+
+    One stream polls its subreddit for new submissions and hands them out
+    to every channel subscribed to it. Submissions arriving together are
+    sent as a single embed per channel instead of one message each.
+
+    :param bot: discord bot
+    :param fetch: coroutine function taking a subreddit and returning its newest submissions
+    :param subreddit: name of the subreddit
+    :param interval: seconds between polls
     """
-    def __init__(self, bot, subreddit, channel):
+    _seen_size = 1000
+    _batch_size = 10
+
+    def __init__(self, bot, fetch, subreddit, interval):
         self.bot = bot
+        self.fetch = fetch
         self.subreddit = subreddit
-        self.channel = channel
+        self.interval = interval
 
-    def process_subsmission(self, submission):
-        pass
+        # ids of subscribed channels
+        self.channels = set()
+
+        # ids of submissions already sent, the deque keeps the set bounded
+        self._seen_order = deque()
+        self._seen = set()
+
+        self._task = bot.loop.create_task(self.stream_task())
+
+    def _mark_seen(self, submission_id):
+        if len(self._seen_order) >= self._seen_size:
+            self._seen.discard(self._seen_order.popleft())
+
+        self._seen_order.append(submission_id)
+        self._seen.add(submission_id)
+
+    def process_submission(self, submissions):
+        """Turns a batch of submissions into a single embed"""
+        if len(submissions) == 1:
+            submission = submissions[0]
+
+            embed = discord.Embed(title=submission.title[:256], url=submission.url)
+            embed.set_author(name='New post in /r/{}'.format(self.subreddit))
+            embed.set_image(url=submission.url)
+            return embed
+
+        embed = discord.Embed(title='{} new posts in /r/{}'.format(len(submissions), self.subreddit))
+        for submission in submissions:
+            embed.add_field(name=submission.title[:256], value=submission.url[:1024], inline=False)
+
+        return embed
+
+    async def deliver(self, submissions):
+        for i in range(0, len(submissions), self._batch_size):
+            embed = self.process_submission(submissions[i:i + self._batch_size])
+
+            for channel_id in tuple(self.channels):
+                channel = self.bot.get_channel(channel_id)
+
+                if channel is not None:
+                    await self.bot.send_message(channel, embed=embed)
 
     async def stream_task(self):
-        for submission in self.subreddit.stream.submission():
-            message = self.process_subsmission(submission)
-            await self.bot.send_message(self.channel, message)
+        first_poll = True
+
+        while True:
+            try:
+                submissions = await self.fetch(self.subreddit)
+            except Exception as e:
+                print('Failed to poll /r/{}: {}: {}'.format(self.subreddit, type(e).__name__, e))
+                await asyncio.sleep(self.interval)
+                continue
+
+            # listings are newest first
+            new = [s for s in reversed(submissions) if s.id not in self._seen]
+            for submission in new:
+                self._mark_seen(submission.id)
+
+            # the first poll only fills the seen set, otherwise subscribing dumps the whole listing
+            if new and not first_poll:
+                try:
+                    await self.deliver(new)
+                except discord.HTTPException as e:
+                    print('Failed to deliver /r/{}: {}'.format(self.subreddit, e))
+
+            first_poll = False
+            await asyncio.sleep(self.interval)
+
+    def close(self):
+        self._task.cancel()
+
+
+class ListingCache:
+    """Caches the parsed result of a listing per subreddit
+
+    Entries younger than ttl are served as they are. Older ones are still
+    served while a refresh runs in the background, until they reach max_age,
+    only then does the caller have to wait for reddit.
+    At most one refresh per subreddit runs at a time.
+
+    :param loop: event loop to run refreshes on
+    :param ttl: seconds an entry counts as fresh
+    :param max_age: seconds after which an entry isn't served anymore
+    """
+
+    def __init__(self, loop, ttl, max_age):
+        self.loop = loop
+        self.ttl = ttl
+        self.max_age = max_age
+
+        # subreddit -> (time fetched, value)
+        self.entries = {}
+        self.refreshing = {}
+
+        self.stats = {'hits': 0, 'stale': 0, 'misses': 0}
+
+    async def get(self, subreddit, fetch):
+        """
+        :param subreddit: key to cache under
+        :param fetch: coroutine function returning a fresh value
+        :return: cached or freshly fetched value
+        """
+        entry = self.entries.get(subreddit)
+
+        if entry is not None:
+            age = time.monotonic() - entry[0]
+
+            if age < self.ttl:
+                self.stats['hits'] += 1
+                return entry[1]
+
+            if age < self.max_age:
+                self.stats['stale'] += 1
+                self._refresh(subreddit, fetch)
+                return entry[1]
+
+        self.stats['misses'] += 1
+
+        # shielded so a cancelled command doesn't cancel the refresh for everyone else
+        return await asyncio.shield(self._refresh(subreddit, fetch))
+
+    def _refresh(self, subreddit, fetch):
+        task = self.refreshing.get(subreddit)
+
+        if task is None:
+            task = asyncio.ensure_future(fetch(), loop=self.loop)
+            task.add_done_callback(functools.partial(self._refreshed, subreddit))
+            self.refreshing[subreddit] = task
+
+        return task
+
+    def _refreshed(self, subreddit, task):
+        del self.refreshing[subreddit]
+
+        if task.cancelled():
+            return
+
+        if task.exception() is not None:
+            print('Failed to refresh /r/{}: {}'.format(subreddit, task.exception()))
+        else:
+            self.entries[subreddit] = (time.monotonic(), task.result())
+
+    def invalidate(self, subreddit=None):
+        """Drops one subreddit, or everything if none is given"""
+        if subreddit is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(subreddit, None)
+
+
+class RandomPool:
+    """Keeps random posts of a few subreddits ready to be handed out
+
+    A background task tops every pool up to depth urls whenever one is taken.
+    Each channel remembers the last recent_size urls it got, those are
+    skipped so the same image doesn't show up twice in a row.
+
+    :param loop: event loop to run the refill task on
+    :param fetch: coroutine function taking a subreddit and returning a random url
+    :param subreddits: subreddits to keep a pool for
+    :param depth: amount of urls to keep ready per subreddit
+    :param recent_size: amount of urls remembered per channel
+    """
+    _retry_delay = 30
+
+    def __init__(self, loop, fetch, subreddits, depth, recent_size):
+        self.fetch = fetch
+        self.depth = depth
+        self.recent_size = recent_size
+
+        self.pools = {subreddit: deque() for subreddit in subreddits}
+
+        # channel id -> (deque of urls in order sent, set of the same urls)
+        self.recent = {}
+
+        self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        self._task = loop.create_task(self._refill_task())
+
+    def _seen(self, channel_id, url):
+        return channel_id in self.recent and url in self.recent[channel_id][1]
+
+    def _remember(self, channel_id, url):
+        order, urls = self.recent.setdefault(channel_id, (deque(), set()))
+        if url in urls:
+            return
+
+        if len(order) >= self.recent_size:
+            urls.discard(order.popleft())
+
+        order.append(url)
+        urls.add(url)
+
+    async def get(self, subreddit, channel_id):
+        """:return: url of a random post not recently sent to the channel, if possible"""
+        pool = self.pools[subreddit]
+        url = None
+
+        for _ in range(len(pool)):
+            candidate = pool.popleft()
+
+            if not self._seen(channel_id, candidate):
+                url = candidate
+                break
+
+            # another channel might still want it
+            pool.append(candidate)
+
+        self._wakeup.set()
+
+        # pool ran dry, so fall back to asking reddit directly
+        for _ in range(3):
+            if url is not None and not self._seen(channel_id, url):
+                break
+            url = await self.fetch(subreddit)
+
+        self._remember(channel_id, url)
+        return url
+
+    async def _refill(self, subreddit, pool):
+        # give up after a while on subreddits too small to fill the pool with unique urls
+        for _ in range(self.depth * 2):
+            if len(pool) >= self.depth:
+                return
+
+            url = await self.fetch(subreddit)
+            if url not in pool:
+                pool.append(url)
+
+    async def _refill_task(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            for subreddit, pool in self.pools.items():
+                try:
+                    await self._refill(subreddit, pool)
+                except Exception as e:
+                    print('Failed to refill /r/{}: {}: {}'.format(subreddit, type(e).__name__, e))
+                    await asyncio.sleep(self._retry_delay)
+                    self._wakeup.set()
+
+    def close(self):
+        self._task.cancel()
 
 
 class Reddit:
-    """Commands for grabbing data from reddit"""
+    """Commands for grabbing data from reddit
+
+    praw is blocking, so every request goes through _request which runs it
+    on a worker thread with a timeout and records how long it took.
+    praw isn't thread safe, so there is a single worker and every use
+    of self.r, including attribute access that lazily fetches, happens on it
+    """
+    _workers = 1
+    _timeout = 10
+    _listing_ttl = 5 * 60
+    _listing_max_age = 60 * 60
+    _pool_depth = 5
+    _recent_size = 50
+    _stream_interval = 60
 
     def __init__(self, bot):
         self.bot = bot
         self.r = praw.Reddit('waifu_bot')
+
+        # subreddit -> Stream
         self.streams = {}
 
-    @commands.command()
-    async def anime(self):
-        """Returns any new anime releases from /r/anime
-        to the sender's channel
+        self.executor = ThreadPoolExecutor(max_workers=self._workers)
+
+        # request name -> latency counters
+        self.latency = {}
+
+        self.listings = ListingCache(bot.loop, self._listing_ttl, self._listing_max_age)
+        self.pool = RandomPool(bot.loop, self._random_url, MOE_SUBREDDITS + ['onetrueidol'],
+                               self._pool_depth, self._recent_size)
+
+    def __unload(self):
+        for stream in self.streams.values():
+            stream.close()
+
+        self.pool.close()
+        self.executor.shutdown(wait=False)
+
+    def _record(self, name, elapsed, failed):
+        stats = self.latency.setdefault(name, {'calls': 0, 'errors': 0, 'total': 0.0, 'max': 0.0})
+        stats['calls'] += 1
+        stats['errors'] += failed
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+
+    async def _request(self, name, func, *args):
+        """Runs a blocking praw call on the worker pool
+
+        :param name: name to record the latency under
+        :param func: callable doing the actual request, listings are lazy
+                     so it has to consume them itself
+        :return: whatever func returns, raises asyncio.TimeoutError after _timeout seconds
         """
-        subreddit = self.r.subreddit('anime')
+        start = time.perf_counter()
+        failed = True
+
+        try:
+            call = functools.partial(func, *args)
+            result = await asyncio.wait_for(self.bot.loop.run_in_executor(self.executor, call), self._timeout)
+            failed = False
+            return result
+        finally:
+            self._record(name, time.perf_counter() - start, failed)
+
+    async def _hot(self, subreddit, limit):
+        """:return: list of hot submissions of the subreddit"""
+        return await self._request('hot', lambda: list(self.r.subreddit(subreddit).hot(limit=limit)))
+
+    async def _new(self, subreddit, limit=25):
+        """:return: list of the newest submissions of the subreddit"""
+        return await self._request('new', lambda: list(self.r.subreddit(subreddit).new(limit=limit)))
+
+    async def _random_url(self, subreddit):
+        """:return: url of a random submission of the subreddit"""
+        # random() only knows the id, reading url is what fetches the submission
+        return await self._request('random', lambda: self.r.subreddit(subreddit).random().url)
+
+    @commands.group(name='reddit', hidden=True)
+    @check.is_owner()
+    async def _reddit(self):
+        pass
+
+    @_reddit.command()
+    async def stats(self):
+        """Shows latency of the requests made to reddit"""
+        lines = ['{:<8}{:>7}{:>7}{:>10}{:>10}'.format('request', 'calls', 'errors', 'avg ms', 'max ms')]
+
+        for name, stats in sorted(self.latency.items()):
+            lines.append('{:<8}{:>7}{:>7}{:>10.1f}{:>10.1f}'.format(name, stats['calls'], stats['errors'],
+                                                                    stats['total'] / stats['calls'] * 1000,
+                                                                    stats['max'] * 1000))
+
+        await self.bot.say(convert_to_codeblock('\n'.join(lines)))
+
+    @_reddit.command()
+    async def cache(self):
+        """Shows what is in the listing cache"""
+        now = time.monotonic()
+        stats = self.listings.stats
+
+        lines = ['hits {hits}, stale {stale}, misses {misses}'.format(**stats)]
+        for subreddit, (fetched, value) in sorted(self.listings.entries.items()):
+            lines.append('/r/{:<12} {:>4} entries, {:>5.0f}s old'.format(subreddit, len(value), now - fetched))
+
+        await self.bot.say(convert_to_codeblock('\n'.join(lines)))
+
+    @_reddit.command()
+    async def invalidate(self, subreddit: str = None):
+        """Drops a subreddit from the listing cache, or all of them"""
+        self.listings.invalidate(subreddit)
+        await self.bot.say('\N{OK HAND SIGN}')
+
+    @commands.group(pass_context=True)
+    @check.is_owner()
+    async def stream(self, ctx):
+        """Posts new submissions of a subreddit to a channel"""
+        if ctx.invoked_subcommand is None:
+            await self.bot.say('Usage: stream add/remove <subreddit> #channel, or stream list')
+
+    @stream.command(name='add')
+    async def stream_add(self, subreddit: str, channel: discord.Channel):
+        """Subscribes a channel to a subreddit"""
+        subreddit = subreddit.lower()
+
+        if subreddit not in self.streams:
+            self.streams[subreddit] = Stream(self.bot, self._new, subreddit, self._stream_interval)
+
+        self.streams[subreddit].channels.add(channel.id)
+        await self.bot.say('\N{OK HAND SIGN}')
+
+    @stream.command(name='remove')
+    async def stream_remove(self, subreddit: str, channel: discord.Channel):
+        """Unsubscribes a channel from a subreddit"""
+        stream = self.streams.get(subreddit.lower())
+
+        if stream is None or channel.id not in stream.channels:
+            await self.bot.say('{} is not subscribed to /r/{}'.format(channel.mention, subreddit))
+            return
+
+        stream.channels.discard(channel.id)
+
+        # stop polling once nobody is listening anymore
+        if not stream.channels:
+            stream.close()
+            del self.streams[stream.subreddit]
+
+        await self.bot.say('\N{OK HAND SIGN}')
+
+    @stream.command(name='list')
+    async def stream_list(self):
+        """Shows all streams and their channels"""
+        lines = []
+        for subreddit, stream in sorted(self.streams.items()):
+            channels = ', '.join('<#{}>'.format(c) for c in stream.channels)
+            lines.append('/r/{}: {}'.format(subreddit, channels))
+
+        await self.bot.say('\n'.join(lines) or 'No active streams')
+
+    async def _anime_releases(self):
         l = []
 
-        for submission in subreddit.hot(limit=20):
+        for submission in await self._hot('anime', 20):
             if submission.title.startswith('[Spoilers]'):
                 name = ' '.join(submission.title.split(' ')[1:-1])
                 l.append(name)
 
-        await self.bot.say('\n'.join(l))
+        return l
 
-    @commands.command()
-    async def manga(self):
-        """Returns any new manga releases from /r/manga
-        to the sender's channel
-        """
-        subreddit = self.r.subreddit('manga')
+    async def _manga_releases(self):
         l = []
 
-        for submission in subreddit.hot(limit=10):
+        for submission in await self._hot('manga', 10):
             if submission.title.startswith('[DISC]'):
                 name = ' '.join(submission.title.split(' ')[1:])
                 l.append(name)
 
+        return l
+
+    @commands.command()
+    async def anime(self):
+        """Returns any new anime releases from /r/anime
+        to the sender's channel
+        """
+        l = await self.listings.get('anime', self._anime_releases)
+
         await self.bot.say('\n'.join(l))
 
     @commands.command()
-    async def moe(self):
+    async def manga(self):
+        """Returns any new manga releases from /r/manga
+        to the sender's channel
+        """
+        l = await self.listings.get('manga', self._manga_releases)
+
+        await self.bot.say('\n'.join(l))
+
+    @commands.command(pass_context=True)
+    async def moe(self, ctx):
         """Returns an image url from a random moe subreddit"""
-        subreddit = rnd.choice(['headpats', 'animeponytails', 'cutelittlefangs'])
-        post = self.r.subreddit(subreddit).random()
+        subreddit = rnd.choice(MOE_SUBREDDITS)
+        url = await self.pool.get(subreddit, ctx.message.channel.id)
         
-        embed = discord.Embed(title='Link', url=post.url)
-        embed.set_image(url=post.url)
+        embed = discord.Embed(title='Link', url=url)
+        embed.set_image(url=url)
                  
         await self.bot.say(embed=embed)
         
-    @commands.command()
-    async def maki(self):
-        post = self.r.subreddit('onetrueidol').random()
+    @commands.command(pass_context=True)
+    async def maki(self, ctx):
+        url = await self.pool.get('onetrueidol', ctx.message.channel.id)
            
-        embed = discord.Embed(title='Maki', url=post.url)
-        embed.set_image(url=post.url)
+        embed = discord.Embed(title='Maki', url=url)
+        embed.set_image(url=url)
         
         await self.bot.say(embed=embed)
 
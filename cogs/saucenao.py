@@ -1,10 +1,19 @@
 import discord 
 from discord.ext import commands
 
+import asyncio
 import json
 import os
+from collections import deque
 
+from .utils import check
+from .utils.database import Database
+from .utils.formatting import convert_to_codeblock
+from .saucenaopy.backfill import BackfillQueue
+from .saucenaopy.cache import ResultCache, url_key, content_key
+from .saucenaopy.limiter import RateLimited
 from .saucenaopy.saucenao import SauceNAO
+from .saucenaopy.similarity import dhash
 
 
 def get_api_key():
@@ -16,12 +25,81 @@ def get_api_key():
 		return json.load(f)['API_KEY']
 
 
-def parse_sauce_response(response):
+def state_path(bot, name):
 	"""
-	:param: requests.Response object to parse
-	:return: parsed Dict
+	Path of a state file in cogs/saucenaopy, every shard gets its own
+	:param name: file name without extension
 	"""
-	results = response.json()['results']
+	if bot.shard_id is not None:
+		name += '-{}'.format(bot.shard_id)
+
+	return os.getcwd() + '/cogs/saucenaopy/{}.json'.format(name)
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp', '.bmp')
+
+
+def image_urls(message):
+	"""
+	Finds the images attached or embedded in a message
+	:param message: discord message object
+	:return: list of image urls in the order they appear
+	"""
+	urls = []
+
+	for attachment in message.attachments:
+		# discord only gives dimensions for images
+		if 'width' in attachment or attachment['filename'].lower().endswith(IMAGE_EXTENSIONS):
+			urls.append(attachment['url'])
+
+	for embed in message.embeds:
+		if 'image' in embed:
+			urls.append(embed['image']['url'])
+		elif embed.get('type') == 'image' and 'url' in embed:
+			urls.append(embed['url'])
+
+	return urls
+
+
+def sauce_link(result):
+	"""
+	Where a result was found, not every index gives urls
+	:return: first url of the result, else its source or the name of the index
+	"""
+	urls = result['data'].get('ext_urls')
+	if urls:
+		return urls[0]
+
+	return result['data'].get('source') or result['header'].get('index_name', 'unknown source')
+
+
+def sauce_summary(result):
+	"""One line version of sauce_to_string for backfill summaries"""
+	if result is None:
+		return 'No sauce found'
+
+	return '{}% {}'.format(result['header']['similarity'], sauce_link(result))
+
+
+def format_eta(seconds):
+	"""Formats a wait time like 1h 5m or 40s"""
+	minutes, seconds = divmod(int(seconds) + 1, 60)
+	hours, minutes = divmod(minutes, 60)
+
+	if hours:
+		return '{}h {}m'.format(hours, minutes)
+	elif minutes:
+		return '{}m {}s'.format(minutes, seconds)
+	else:
+		return '{}s'.format(seconds)
+
+
+def parse_sauce_response(data):
+	"""
+	:param: decoded SauceNAO response to parse
+	:return: list of results, most similar last
+	"""
+	results = data.get('results', [])
 
 	# sort based on similarity
 	results.sort(key=lambda res: float(res['header']['similarity']))
@@ -34,16 +112,23 @@ def sauce_to_string(result):
 	Converts a result into text that the bot can say
 	TODO: Hacky code
 	"""
+	# copy, results can come from the cache
+	data = dict(result['data'])
 
 	# leave only 1 url
-	result['data']['url'] = result['data']['ext_urls'][0]
-	result['data'].pop('ext_urls')
+	urls = data.pop('ext_urls', None)
+	if urls:
+		data['url'] = urls[0]
 
 	# remove empty source
-	if 'source' in result['data'] and result['data']['source']:
-		result['data'].pop(source)
+	if 'source' in data and not data['source']:
+		data.pop('source')
 
-	content = ''.join(['{}: {}\n'.format(key, val) for key, val in result['data'].items()])
+	# without url or source at least tell which index it is from
+	if 'url' not in data and 'source' not in data:
+		data['index'] = sauce_link(result)
+
+	content = ''.join(['{}: {}\n'.format(key, val) for key, val in data.items()])
 
 	ret = '- - -\nSimilarity: {}%\n{}- - -'.format(
 		result['header']['similarity'], 
@@ -54,29 +139,389 @@ def sauce_to_string(result):
 
 
 class SourceRequester:
+	# seconds a lookup may wait for the rate limits before it's refused
+	queue_timeout = 60
+
+	# lookups are cached on disk for a month, up to this many keys
+	cache_ttl = 30 * 24 * 60 * 60
+	cache_size = 20000
+
+	# amount of image urls remembered per channel for sauce last
+	recent_images = 50
+
+	# part of the daily quota a backfill leaves for people using the commands
+	backfill_reserve = 50
+	# lookups per summary message
+	backfill_batch = 10
+
+	# images whose perceptual hashes differ in at most this many of 64 bits count as the same
+	similarity_threshold = 6
+
 	def __init__(self, bot):
 		self.bot = bot
-		self.sn = SauceNAO(get_api_key())
+		self.sn = SauceNAO(get_api_key(), loop=bot.loop, state_path=state_path(bot, 'quota'))
 
-	def get_source(self, url: str):
-		response = self.sn.get_sauce(url)
+		self.db = Database('sauce_cache.db', loop=bot.loop)
+		self.cache = ResultCache(self.db, self.cache_ttl, self.cache_size)
 
-		if response is None:
+		# url key -> future of the lookup running for it
+		self.in_flight = {}
+		self.coalesced = 0
+
+		# channel id -> deque of the newest image urls, newest last
+		self.recent = {}
+
+		# backfills only run on the first shard, so they aren't done once per shard
+		self.backfills = None
+		self._backfill_wakeup = asyncio.Event()
+		self._backfill_task = None
+
+		if not bot.shard_id:
+			self.backfills = BackfillQueue(state_path(bot, 'backfill'))
+			self._backfill_task = bot.loop.create_task(self.backfill_task())
+
+			# continue backfills from before a restart
+			if self.backfills.jobs:
+				self._backfill_wakeup.set()
+
+	def __unload(self):
+		if self.backfills is not None:
+			self._backfill_task.cancel()
+			self.backfills.save()
+
+		self.sn.close()
+		self.db.close()
+
+	async def lookup(self, url: str):
+		"""Finds the best match for an image, from the cache if possible
+
+		Concurrent lookups of the same url share a single lookup,
+		and only a real SauceNAO request takes rate limit tokens.
+
+		:return: best result, None if there isn't any or the lookup failed
+		"""
+		key = url_key(url)
+		future = self.in_flight.get(key)
+
+		if future is None:
+			future = asyncio.ensure_future(self._lookup(url, key), loop=self.bot.loop)
+			future.add_done_callback(lambda f: self._lookup_done(key, f))
+			self.in_flight[key] = future
+		else:
+			self.coalesced += 1
+
+		# shielded so one cancelled caller doesn't cancel the lookup for the others
+		return await asyncio.shield(future)
+
+	def _lookup_done(self, key, future):
+		del self.in_flight[key]
+
+		# mark the exception as retrieved in case every caller went away
+		if not future.cancelled():
+			future.exception()
+
+	async def _lookup(self, url, key):
+		keys = [key]
+		found, result = await self.cache.get(keys[0])
+		if found:
+			return result
+
+		# the same image is often posted under a different url, or resized
+		# only images on discord's cdn are downloaded, others are only cached by their url
+		content = await self.sn.fetch_image(url)
+		phash = None
+
+		if content is not None:
+			keys.append(content_key(content))
+			found, result = await self.cache.get(keys[1])
+
+			if not found:
+				phash = await self.bot.loop.run_in_executor(None, dhash, content)
+
+				if phash is not None:
+					found, result = await self.cache.get_similar(phash, self.similarity_threshold)
+
+			if found:
+				await self.cache.put(keys, result)
+				return result
+
+		self.cache.miss()
+		data = await self.sn.get_sauce(url, timeout=self.queue_timeout)
+
+		# failed lookups aren't cached, so they can be retried
+		if data is None:
 			return None
 
-		results = parse_sauce_response(response)
+		results = parse_sauce_response(data)
+		result = results[-1] if results else None
 
-		if len(results):
-			return sauce_to_string(results[-1])
+		await self.cache.put(keys, result)
+
+		if phash is not None:
+			await self.cache.put_hash(phash, keys[1])
+
+		return result
+
+	async def get_source(self, url: str):
+		result = await self.lookup(url)
+
+		if result is not None:
+			return sauce_to_string(result)
 		else:
 			return None
 
+	def remember_images(self, message):
+		urls = image_urls(message)
+		if not urls:
+			return
+
+		recent = self.recent.get(message.channel.id)
+		if recent is None:
+			recent = self.recent[message.channel.id] = deque(maxlen=self.recent_images)
+
+		for url in urls:
+			if url not in recent:
+				recent.append(url)
+
+	async def on_message(self, message):
+		self.remember_images(message)
+
+	async def on_message_edit(self, before, after):
+		# discord adds embeds for links a moment after the message was sent
+		if len(after.embeds) > len(before.embeds):
+			self.remember_images(after)
+
+	def _backfill_wait(self):
+		"""
+		Seconds the backfill has to wait, it may only spend the daily
+		quota above backfill_reserve and never queue up in the limiters
+		"""
+		short, long = self.sn.limiters
+		short_wait = short.wait_time()
+		# also refills the long bucket before reading its tokens, and covers an exhausted quota
+		long_wait = long.wait_time()
+
+		reserve_wait = (self.backfill_reserve + 1 - long.tokens) / long.rate
+		return max(0, short_wait, long_wait, reserve_wait)
+
+	async def _backfill_page(self, channel_id):
+		"""Reads the next page of a channel's history and queues its images"""
+		job = self.backfills.jobs[channel_id]
+		channel = self.bot.get_channel(channel_id)
+
+		if channel is None:
+			job['paged'] = True
+			return
+
+		before = discord.Object(id=job['before']) if job['before'] else None
+		read = 0
+
+		try:
+			async for message in self.bot.logs_from(channel, limit=min(100, job['remaining']), before=before):
+				read += 1
+				job['before'] = message.id
+
+				for url in image_urls(message):
+					self.backfills.push(channel_id, message.id, url)
+		except discord.HTTPException as e:
+			# most likely no permission to read the history, retrying won't help
+			# the images queued so far still get looked up
+			job['paged'] = True
+			job['error'] = '{}: {}'.format(type(e).__name__, e)
+			await self._backfill_send(job, 'Stopped reading <#{}>, {}'.format(channel_id, job['error']))
+			return
+
+		job['remaining'] -= read
+		if not read or job['remaining'] <= 0:
+			job['paged'] = True
+
+	async def _backfill_send(self, job, message):
+		""":return: False if the message couldn't be sent to the job's report channel"""
+		report = self.bot.get_channel(job['report'])
+		if report is None:
+			return False
+
+		try:
+			await self.bot.send_message(report, message)
+		except discord.HTTPException as e:
+			print('Failed to post backfill report in {}: {}: {}'.format(job['report'], type(e).__name__, e))
+			return False
+
+		return True
+
+	async def _backfill_report(self, channel_id, final=False):
+		"""Posts the results collected so far in one message"""
+		job = self.backfills.jobs[channel_id]
+		results, job['results'] = job['results'], []
+
+		lines = ['<{}> {}'.format(url, summary) for url, summary in results]
+
+		if final:
+			fmt = 'Backfill of <#{}> done, found sources for {} of {} images'
+			lines.append(fmt.format(channel_id, job['found'], job['images']))
+
+			if job.get('error'):
+				lines.append('Only part of the history was read, ' + job['error'])
+
+		# keep every message under discord's 2000 character limit
+		message = ''
+		for line in lines:
+			if message and len(message) + len(line) + 1 > 2000:
+				# results that can't be posted are dropped, the backfill itself goes on
+				if not await self._backfill_send(job, message):
+					return
+				message = ''
+
+			message += line + '\n'
+
+		if message:
+			await self._backfill_send(job, message)
+
+	async def _backfill_finish(self):
+		for channel_id in self.backfills.finished():
+			await self._backfill_report(channel_id, final=True)
+			del self.backfills.jobs[channel_id]
+
+		self.backfills.save()
+
+	async def backfill_task(self):
+		await self.bot.wait_until_ready()
+
+		while True:
+			await self._backfill_wakeup.wait()
+
+			try:
+				await self._backfill_step()
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				# keep the other backfills going, but don't spin on whatever broke
+				print('Backfill step failed: {}: {}'.format(type(e).__name__, e))
+				await asyncio.sleep(60)
+
+	async def _backfill_step(self):
+		"""Reads a page of history, or looks up one image"""
+		# only read more history once the queue runs low
+		channel_id = self.backfills.needs_paging()
+		if channel_id is not None and len(self.backfills) < self.backfill_batch:
+			await self._backfill_page(channel_id)
+			self.backfills.save()
+			return
+
+		item = self.backfills.pop()
+		if item is None:
+			await self._backfill_finish()
+
+			if not self.backfills.jobs:
+				self._backfill_wakeup.clear()
+			return
+
+		wait = self._backfill_wait()
+		if wait:
+			# checkpoint and post what we have before sleeping, this can take hours
+			self.backfills.push_back(item)
+			self.backfills.save()
+
+			for job_id, job in list(self.backfills.jobs.items()):
+				if job['results']:
+					await self._backfill_report(job_id)
+
+			await asyncio.sleep(wait)
+			return
+
+		channel_id, message_id, url = item
+
+		try:
+			result = await self.lookup(url)
+		except RateLimited as e:
+			self.backfills.push_back(item)
+			await asyncio.sleep(e.retry_after)
+			return
+		except Exception as e:
+			print('Backfill lookup of {} failed: {}: {}'.format(url, type(e).__name__, e))
+			result = None
+
+		job = self.backfills.jobs[channel_id]
+		job['found'] += result is not None
+		job['results'].append((url, sauce_summary(result)))
+
+		if len(job['results']) >= self.backfill_batch:
+			await self._backfill_report(channel_id)
+
+		if job['paged'] and not job['pending']:
+			await self._backfill_finish()
+		else:
+			self.backfills.save()
+
 	@commands.group()
 	async def sauce(self):
-		#messages = self.bot.messages
-		#await self.bot.say(self.bot.messages[-1].embeds)
 		pass
 
+	@sauce.command(pass_context=True)
+	@check.is_owner()
+	async def backfill(self, ctx, channel: discord.Channel, limit: int = 1000):
+		"""Looks up the sources of all images in the last limit messages of a channel"""
+		if self.backfills is None:
+			await self.bot.say('Backfills only run on shard 0, this is shard {}'.format(self.bot.shard_id))
+			return
+
+		self.backfills.add_job(channel.id, ctx.message.channel.id, limit)
+		self.backfills.save()
+		self._backfill_wakeup.set()
+
+		await self.bot.say('Started a backfill of the last {} messages in {}'.format(limit, channel.mention))
+
+	@sauce.command(pass_context=True)
+	async def last(self, ctx, n: int = 1):
+		"""Looks up the source of the last n images posted in this channel, at most 5"""
+		recent = self.recent.get(ctx.message.channel.id)
+
+		if not recent:
+			await self.bot.say("I haven't seen any images here yet")
+			return
+
+		urls = list(recent)[-max(1, min(n, 5)):]
+
+		try:
+			results = await asyncio.gather(*[self.get_source(url) for url in urls])
+		except RateLimited as e:
+			await self.bot.say('Out of lookups for now, try again in {}'.format(format_eta(e.retry_after)))
+			return
+
+		# keep every message under discord's 2000 character limit
+		message = ''
+		for url, result in zip(urls, results):
+			part = '<{}>\n{}\n'.format(url, result or 'No sauce found')
+
+			if message and len(message) + len(part) > 2000:
+				await self.bot.say(message)
+				message = ''
+
+			message += part
+
+		await self.bot.say(message)
+
+	@sauce.command(hidden=True)
+	@check.is_owner()
+	async def stats(self):
+		"""Shows result cache and rate limit counters"""
+		stats = self.cache.stats
+		short, long = self.sn.limiters
+
+		lines = [
+			'Url hits      {}'.format(stats['url_hits']),
+			'Content hits  {}'.format(stats['content_hits']),
+			'Similar hits  {} ({} hashes)'.format(stats['similar_hits'], len(self.cache.index)),
+			'Misses        {}'.format(stats['misses']),
+			'Coalesced     {}'.format(self.coalesced),
+			'Evicted       {}'.format(stats['evicted']),
+			'Short quota   {:.0f}/{}'.format(max(short.tokens, 0), short.limit),
+			'Long quota    {:.0f}/{}'.format(max(long.tokens, 0), long.limit),
+			'Next lookup   {}'.format(format_eta(self.sn.eta()) if self.sn.eta() else 'now'),
+		]
+
+		await self.bot.say(convert_to_codeblock('\n'.join(lines)))
+
 	@sauce.command()
 	async def url(self, *, url: str):
 		"""
@@ -93,7 +538,11 @@ class SourceRequester:
 		else:
 			await self.bot.say('No sauce found')
 		"""
-		result = self.get_source(url)
+		try:
+			result = await self.get_source(url)
+		except RateLimited as e:
+			await self.bot.say('Out of lookups for now, try again in {}'.format(format_eta(e.retry_after)))
+			return
 
 		if result is not None:
 			await self.bot.say(result)
@@ -0,0 +1,105 @@
+import heapq
+import json
+import os
+
+
+class BackfillQueue:
+  """Persistent work queue for looking up the images of whole channels
+
+  Every backfilled channel has a job remembering how far back its history
+  has been read, the images found but not looked up yet sit in a heap
+  shared by all jobs, newest messages first.
+  Everything is written to path on save(), so backfills continue where
+  they left off after a restart.
+
+  job format:
+    report    id of the channel to post the summaries in
+    before    id of the oldest message read so far, None before the first page
+    remaining amount of messages still to read
+    paged     True once the whole history (or limit) has been read
+    images    amount of images queued so far
+    pending   amount of images in the heap
+    found     amount of images a source was found for
+    results   [url, summary] pairs that haven't been posted yet
+    error     why reading the history stopped early, None if it didn't
+  """
+
+  def __init__(self, path):
+    self.path = path
+
+    # channel id -> job
+    self.jobs = {}
+    self.heap = []
+
+    self.load()
+
+  def __len__(self):
+    return len(self.heap)
+
+  def load(self):
+    if not os.path.exists(self.path):
+      return
+
+    try:
+      with open(self.path) as f:
+        state = json.load(f)
+
+      self.jobs = state['jobs']
+      self.heap = [tuple(item) for item in state['queue']]
+      heapq.heapify(self.heap)
+    except (ValueError, KeyError) as e:
+      print('Ignoring broken backfill state', self.path, e)
+
+  def save(self):
+    temp_path = self.path + '.tmp'
+    with open(temp_path, 'w') as f:
+      json.dump({'jobs': self.jobs, 'queue': self.heap}, f)
+    os.replace(temp_path, self.path)
+
+  def add_job(self, channel_id, report_id, limit):
+    """Starts a backfill, or restarts the one already running for the channel"""
+    self.heap = [item for item in self.heap if item[1] != channel_id]
+    heapq.heapify(self.heap)
+
+    self.jobs[channel_id] = {
+      'report': report_id,
+      'before': None,
+      'remaining': limit,
+      'paged': False,
+      'images': 0,
+      'pending': 0,
+      'found': 0,
+      'results': [],
+      'error': None,
+    }
+
+  def push(self, channel_id, message_id, url):
+    # message ids grow over time, so negating them puts the newest first
+    heapq.heappush(self.heap, (-int(message_id), channel_id, message_id, url))
+    self.jobs[channel_id]['images'] += 1
+    self.jobs[channel_id]['pending'] += 1
+
+  def pop(self):
+    """:return: tuple of (channel id, message id, url), None if the queue is empty"""
+    if not self.heap:
+      return None
+
+    _, channel_id, message_id, url = heapq.heappop(self.heap)
+    self.jobs[channel_id]['pending'] -= 1
+    return channel_id, message_id, url
+
+  def push_back(self, item):
+    """Puts a popped item back, for lookups that have to wait for the quota"""
+    channel_id, message_id, url = item
+    heapq.heappush(self.heap, (-int(message_id), channel_id, message_id, url))
+    self.jobs[channel_id]['pending'] += 1
+
+  def needs_paging(self):
+    """:return: id of a channel whose history still has to be read, None if there is none"""
+    for channel_id, job in self.jobs.items():
+      if not job['paged']:
+        return channel_id
+
+  def finished(self):
+    """:return: ids of the channels that are read completely and have nothing queued anymore"""
+    return [channel_id for channel_id, job in self.jobs.items() if job['paged'] and not job['pending']]
@@ -0,0 +1,204 @@
+import hashlib
+import json
+import time
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from .similarity import HashIndex
+
+
+CREATE_RESULTS = """\
+CREATE TABLE IF NOT EXISTS Results (
+  key     TEXT PRIMARY KEY,
+  result  TEXT,
+  created REAL NOT NULL,
+  used    REAL NOT NULL
+)"""
+
+# perceptual hashes as hex, 64 bit hashes don't fit sqlite's signed integers
+CREATE_HASHES = """\
+CREATE TABLE IF NOT EXISTS Hashes (
+  phash TEXT NOT NULL,
+  key   TEXT NOT NULL,
+  PRIMARY KEY (phash, key)
+)"""
+
+CREATE_INDEXES = (
+  'CREATE INDEX IF NOT EXISTS idx_results_used ON Results (used)',
+  'CREATE INDEX IF NOT EXISTS idx_results_created ON Results (created)',
+)
+
+SELECT_RESULT = 'SELECT result, created FROM Results WHERE key = ?'
+TOUCH_RESULT = 'UPDATE Results SET used = ? WHERE key = ?'
+INSERT_RESULT = 'INSERT OR REPLACE INTO Results (key, result, created, used) VALUES (?, ?, ?, ?)'
+DELETE_EXPIRED = 'DELETE FROM Results WHERE created < ?'
+DELETE_LRU = 'DELETE FROM Results WHERE key IN (SELECT key FROM Results ORDER BY used LIMIT ?)'
+COUNT_RESULTS = 'SELECT COUNT(*) FROM Results'
+INSERT_HASH = 'INSERT OR IGNORE INTO Hashes (phash, key) VALUES (?, ?)'
+SELECT_HASHES = 'SELECT phash, key FROM Hashes'
+DELETE_ORPHAN_HASHES = 'DELETE FROM Hashes WHERE key NOT IN (SELECT key FROM Results)'
+
+
+def normalize_url(url):
+  """Strips the parts of an url that don't change which image it points to
+
+  Malformed urls, like ones with an invalid port, are only stripped of whitespace.
+  """
+  url = url.strip()
+
+  try:
+    parts = urlsplit(url)
+    port = parts.port
+  except ValueError:
+    return url
+
+  host = parts.hostname or ''
+  if host.startswith('www.'):
+    host = host[4:]
+  if port and port not in (80, 443):
+    host = '{}:{}'.format(host, port)
+
+  query = urlencode(sorted(parse_qsl(parts.query)))
+  return urlunsplit(('https', host, parts.path, query, ''))
+
+
+def url_key(url):
+  return 'url:' + normalize_url(url)
+
+
+def content_key(content):
+  return 'sha1:' + hashlib.sha1(content).hexdigest()
+
+
+# The functions below run on the database worker thread
+
+def create_schema(con):
+  con.execute('PRAGMA journal_mode = WAL')
+  con.execute(CREATE_RESULTS)
+  con.execute(CREATE_HASHES)
+  for statement in CREATE_INDEXES:
+    con.execute(statement)
+  con.commit()
+
+
+def get_result(con, key, ttl):
+  """:return: tuple of (found, result), results older than ttl count as not found"""
+  row = con.execute(SELECT_RESULT, (key,)).fetchone()
+  now = time.time()
+
+  if row is None or row[1] < now - ttl:
+    return False, None
+
+  con.execute(TOUCH_RESULT, (now, key))
+  con.commit()
+  return True, json.loads(row[0])
+
+
+def put_result(con, keys, result):
+  now = time.time()
+  encoded = json.dumps(result)
+
+  con.executemany(INSERT_RESULT, [(key, encoded, now, now) for key in keys])
+  con.commit()
+
+
+def evict(con, ttl, max_entries):
+  """Drops expired results, then the least recently used ones above max_entries
+
+  :return: amount of results dropped
+  """
+  before = con.total_changes
+  con.execute(DELETE_EXPIRED, (time.time() - ttl,))
+
+  overflow = con.execute(COUNT_RESULTS).fetchone()[0] - max_entries
+  if overflow > 0:
+    con.execute(DELETE_LRU, (overflow,))
+
+  dropped = con.total_changes - before
+  con.execute(DELETE_ORPHAN_HASHES)
+
+  con.commit()
+  return dropped
+
+
+def put_hash(con, phash, key):
+  con.execute(INSERT_HASH, ('{:016x}'.format(phash), key))
+  con.commit()
+
+
+def get_hashes(con):
+  return [(int(phash, 16), key) for phash, key in con.execute(SELECT_HASHES)]
+
+
+class ResultCache:
+  """Disk backed cache of SauceNAO answers
+
+  Answers are stored under the normalized image url and under a hash of
+  the image content, so the same image posted from another url is still
+  found. Entries expire after ttl seconds, and once there are more than
+  max_entries the least recently used ones are dropped.
+  "No sauce found" answers are cached as well, they cost quota just the same.
+
+  Perceptual hashes of looked up images are kept in a HashIndex pointing
+  at their content key, to find resized or recompressed reposts.
+  Hashes of evicted results stay in the index until the next restart,
+  looking them up simply misses.
+
+  :param db: utils.database.Database to store the results in
+  :param ttl: seconds a result stays valid
+  :param max_entries: amount of keys to keep at most
+  """
+
+  # evict every this many insertions
+  evict_every = 100
+
+  def __init__(self, db, ttl, max_entries):
+    self.db = db
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self._puts = 0
+
+    self.stats = {'url_hits': 0, 'content_hits': 0, 'similar_hits': 0, 'misses': 0, 'evicted': 0}
+
+    db.run_sync(create_schema)
+    self.stats['evicted'] += db.run_sync(evict, ttl, max_entries)
+
+    self.index = HashIndex()
+    for phash, key in db.run_sync(get_hashes):
+      self.index.add(phash, key)
+
+  async def get(self, key):
+    """:return: tuple of (found, result)"""
+    found, result = await self.db.run(get_result, key, self.ttl)
+
+    if found:
+      self.stats['content_hits' if key.startswith('sha1:') else 'url_hits'] += 1
+
+    return found, result
+
+  async def get_similar(self, phash, threshold):
+    """Looks for results of images whose hash is within threshold bits
+
+    :return: tuple of (found, result)
+    """
+    for distance, key in self.index.query(phash, threshold):
+      found, result = await self.db.run(get_result, key, self.ttl)
+
+      if found:
+        self.stats['similar_hits'] += 1
+        return found, result
+
+    return False, None
+
+  async def put_hash(self, phash, key):
+    await self.db.run(put_hash, phash, key)
+    self.index.add(phash, key)
+
+  def miss(self):
+    self.stats['misses'] += 1
+
+  async def put(self, keys, result):
+    await self.db.run(put_result, keys, result)
+
+    self._puts += 1
+    if self._puts % self.evict_every == 0:
+      self.stats['evicted'] += await self.db.run(evict, self.ttl, self.max_entries)
@@ -1,30 +1,161 @@
-from threading import Timer, Semaphore
+import asyncio
+from time import monotonic, time as wall_time
+
+
+class RateLimited(Exception):
+  """Raised when a limiter can't hand out a token within the timeout"""
+
+  def __init__(self, retry_after):
+    super(RateLimited, self).__init__('Rate limited, try again in {:.0f}s'.format(retry_after))
+    self.retry_after = retry_after
+
 
 class Limiter(object):
+  """Token bucket allowing `limit` requests per `time` seconds
+
+  Tokens refill continuously at limit / time per second, so the state is
+  just a counter and a timestamp no matter how many requests are made.
+  Acquiring reserves a token right away, the count may go negative and
+  the caller then sleeps until its token is refilled, so waiters are
+  served in the order they arrived.
+
+  Once the server says the quota is used up the bucket stops refilling
+  until reset_at, a full window after that answer, since refilling
+  continuously would only let requests through for the server to reject.
+  """
 
   def __init__(self, limit, time):
-    self.sema = Semaphore(limit)
+    self.limit = limit
     self.time = time
+    self.rate = limit / time
+
+    self.tokens = float(limit)
+    self.updated = monotonic()
+
+    # acquisitions still sleeping for their token
+    self.waiting = 0
+
+    # wall clock time the server's exhausted quota is back, None while it isn't exhausted
+    self.reset_at = None
+
+  def _refill(self):
+    now = monotonic()
+
+    if self.reset_at is not None:
+      if wall_time() < self.reset_at:
+        # held empty, tokens reserved by sleeping acquisitions stay reserved
+        self.tokens = min(self.tokens, 0.0)
+        self.updated = now
+        return
+
+      self.reset_at = None
+      self.tokens += self.limit
+
+    self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+
+  def wait_time(self):
+    """Seconds until the next token is available"""
+    self._refill()
+
+    if self.reset_at is not None:
+      return self.reset_at - wall_time()
+    return max(0.0, (1 - self.tokens) / self.rate)
+
+  async def acquire(self, timeout=None):
+    """Waits for a token
+
+    :param timeout: seconds to wait at most, None to wait as long as needed
+    :return: raises RateLimited when no token is available in time
+    """
+    self._refill()
+
+    if self.reset_at is not None:
+      delay = self.reset_at - wall_time()
+      if timeout is not None and delay > timeout:
+        raise RateLimited(delay)
+
+      await asyncio.sleep(delay)
+      self._refill()
+
+      if timeout is not None:
+        timeout = max(0.0, timeout - delay)
+
+    self.tokens -= 1
+    delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+    if timeout is not None and delay > timeout:
+      self.tokens += 1
+      raise RateLimited(delay)
+
+    if delay:
+      self.waiting += 1
+      try:
+        await asyncio.sleep(delay)
+      except asyncio.CancelledError:
+        self.release()
+        raise
+      finally:
+        self.waiting -= 1
 
-  def acquire(self):
-    self.sema.acquire()
-    thread = Timer(self.time, self.release)
-    thread.daemon = True
-    thread.start()
-    return thread
-
-  def cancel(self, thread):
-    thread.cancel()
-    self.sema.release()
-      
   def release(self):
-    self.sema.release()
+    """Gives a token back, for requests that didn't count against the quota"""
+    self._refill()
+    self.tokens = min(self.limit, self.tokens + 1)
+
+  def reconcile(self, remaining, limit=None):
+    """Trusts the server's count over our own
+
+    :param remaining: requests the server says are left
+    :param limit: the server's limit, in case it differs from ours
+    """
+    if limit is not None and limit != self.limit:
+      self.limit = limit
+      self.rate = limit / self.time
+
+    self._refill()
+
+    if remaining <= 0:
+      # keep the first reset time, later rejections don't move the window
+      if self.reset_at is None:
+        self.reset_at = wall_time() + self.time
+      self.tokens = -float(self.waiting)
+      return
+
+    self.reset_at = None
+
+    # tokens reserved by sleeping acquisitions haven't reached the server yet
+    self.tokens = min(float(remaining), self.limit) - self.waiting
+
+  def state(self):
+    """:return: dict that can be stored and handed to restore after a restart"""
+    self._refill()
+    return {'tokens': self.tokens + self.waiting, 'limit': self.limit, 'time': wall_time(),
+            'reset_at': self.reset_at}
+
+  def restore(self, state):
+    """Continues from a state saved with state(), refilling for the time in between"""
+    self.limit = state.get('limit', self.limit)
+    self.rate = self.limit / self.time
+
+    self.reset_at = state.get('reset_at')
+    if self.reset_at is not None:
+      # refilling picks up from when the quota is back
+      self.tokens = 0.0
+      self.updated = monotonic()
+      return
+
+    elapsed = max(0.0, wall_time() - state['time'])
+    self.tokens = min(self.limit, state['tokens'] + elapsed * self.rate)
+    self.updated = monotonic()
+
 
 class ShortLimiter(Limiter):
 
   def __init__(self, limit):
     super(ShortLimiter, self).__init__(limit, 30)
 
+
 class LongLimiter(Limiter):
 
   def __init__(self, limit):
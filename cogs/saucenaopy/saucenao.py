@@ -1,11 +1,29 @@
-import sys
+import asyncio
 import json
-import requests
+import os
+from urllib.parse import urlsplit
+import aiohttp
 from .limiter import ShortLimiter, LongLimiter
 
 class SauceNAO:
+  """Async SauceNAO client
 
-  def __init__(self, api_key, output_type=2, testmode=0, dbmask=None, dbmaski=None, db=999, numres=6, shortlimit=20, longlimit=300):
+  All requests share one pooled aiohttp session, so connections to
+  saucenao.com are kept alive in between lookups.
+  Every lookup builds its own parameters, lookups can run concurrently.
+
+  The remaining quota SauceNAO reports with every response overrides the
+  local limiters, and when state_path is given the limiters are saved there
+  after every response so a restart doesn't start with a fresh quota.
+  """
+
+  URL = 'https://saucenao.com/search.php'
+
+  # fetch_image only downloads from these, any other url could point anywhere, the local network included
+  DOWNLOAD_HOSTS = ('cdn.discordapp.com', 'media.discordapp.net', 'images-ext-1.discordapp.net', 'images-ext-2.discordapp.net')
+
+  def __init__(self, api_key, output_type=2, testmode=0, dbmask=None, dbmaski=None, db=999, numres=6, shortlimit=20, longlimit=300, loop=None,
+               timeout=15, retries=3, backoff=1, connections=4, state_path=None):
     params = dict()
     params['api_key'] = api_key
     params['output_type'] = output_type
@@ -14,42 +32,204 @@ class SauceNAO:
     params['dbmaski'] = dbmaski
     params['db'] = db
     params['numres'] = numres
-    self.params = params
 
+    # aiohttp doesn't skip unset parameters like requests did
+    self.params = {key: value for key, value in params.items() if value is not None}
+
+    self.timeout = timeout
+    self.retries = retries
+    self.backoff = backoff
+
+    self.loop = loop or asyncio.get_event_loop()
     self.limiters = (ShortLimiter(shortlimit), LongLimiter(longlimit))
 
-  def get_sauce(self, url):
-    threads = [limiter.acquire() for limiter in self.limiters]
+    self.state_path = state_path
+    self.load_state()
+
+    connector = aiohttp.TCPConnector(limit=connections, keepalive_timeout=60, loop=self.loop)
+    self.session = aiohttp.ClientSession(connector=connector, loop=self.loop)
+
+  def close(self):
+    self.session.close()
+    self.save_state()
+
+  def load_state(self):
+    if self.state_path is None or not os.path.exists(self.state_path):
+      return
+
+    try:
+      with open(self.state_path) as f:
+        states = json.load(f)
+
+      for limiter, state in zip(self.limiters, (states['short'], states['long'])):
+        limiter.restore(state)
+    except (ValueError, KeyError) as e:
+      print('Ignoring broken quota state', self.state_path, e)
+
+  def save_state(self):
+    if self.state_path is None:
+      return
+
+    short, long = self.limiters
+    states = {'short': short.state(), 'long': long.state()}
+
+    # write next to it and swap, so a crash never leaves half a file behind
+    temp_path = self.state_path + '.tmp'
+    with open(temp_path, 'w') as f:
+      json.dump(states, f)
+    os.replace(temp_path, self.state_path)
+
+  def reconcile(self, header):
+    """Updates the limiters from the remaining quota in a response header"""
+    short, long = self.limiters
+
+    try:
+      short.reconcile(int(header['short_remaining']), int(header['short_limit']))
+      long.reconcile(int(header['long_remaining']), int(header['long_limit']))
+    except (KeyError, TypeError, ValueError):
+      return
+
+    self.save_state()
+
+  def eta(self):
+    """:return: seconds until both limiters have a token again"""
+    return max(limiter.wait_time() for limiter in self.limiters)
+
+  async def acquire(self, timeout=None):
+    """Takes a token from every limiter, raises limiter.RateLimited if that takes longer than timeout"""
+    acquired = []
+    try:
+      for limiter in self.limiters:
+        await limiter.acquire(timeout)
+        acquired.append(limiter)
+    except BaseException:
+      self.release(acquired)
+      raise
+
+    return acquired
+
+  def release(self, limiters):
+    [limiter.release() for limiter in limiters]
+
+  async def _request(self, params):
+    async with self.session.get(self.URL, params=params) as response:
+      return response.status, await response.text()
+
+  async def _request_with_retry(self, params):
+    """Retries connection problems, timeouts and server errors with exponential backoff
 
-    self.params['url'] = url
-    response = requests.get('https://saucenao.com/search.php', params=self.params)
+    :return: tuple of (http status, body)
+    """
+    for attempt in range(self.retries + 1):
+      last_try = attempt == self.retries
 
-    if self.verify_http_status(response, threads):
-      data = self.load_json(response)
-      if data is not None and self.verify_header_status(data, threads):
-        return response
+      try:
+        status, text = await asyncio.wait_for(self._request(params), self.timeout)
+      except (aiohttp.ClientError, asyncio.TimeoutError):
+        if last_try:
+          raise
+      else:
+        if status < 500 or last_try:
+          return status, text
 
-  def verify_http_status(self, response, threads):
-    if response.status_code != 200:
-      [thread.cancel() for thread in threads]
-      print('HTTP Status', str(result.status_code))
+      await asyncio.sleep(self.backoff * 2 ** attempt)
+
+  def can_download(self, url):
+    """:return: True if url is an http(s) url on one of DOWNLOAD_HOSTS"""
+    try:
+      parts = urlsplit(url)
+      host = parts.hostname
+      parts.port
+    except ValueError:
+      return False
+
+    return parts.scheme in ('http', 'https') and host in self.DOWNLOAD_HOSTS and not parts.username
+
+  async def _download(self, url, max_size):
+    # a redirect could lead off the allowed hosts
+    async with self.session.get(url, allow_redirects=False) as response:
+      if response.status != 200:
+        return None
+
+      chunks = []
+      size = 0
+
+      while True:
+        chunk = await response.content.read(64 * 1024)
+        if not chunk:
+          return b''.join(chunks)
+
+        size += len(chunk)
+        if size > max_size:
+          return None
+
+        chunks.append(chunk)
+
+  async def fetch_image(self, url, max_size=8 * 1024 * 1024):
+    """Downloads an image through the shared session, doesn't count against the rate limits
+
+    Only urls on DOWNLOAD_HOSTS are downloaded, see can_download.
+
+    :return: content as bytes, None if it couldn't be downloaded, isn't allowed or is larger than max_size
+    """
+    if not self.can_download(url):
+      return None
+
+    try:
+      return await asyncio.wait_for(self._download(url, max_size), self.timeout)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+      return None
+
+  async def get_sauce(self, url, timeout=None):
+    """Looks up the source of an image
+
+    :param url: url of the image
+    :param timeout: seconds to wait for the rate limits at most
+    :return: parsed response, None if the lookup failed
+    """
+    limiters = await self.acquire(timeout)
+
+    params = dict(self.params, url=url)
+
+    try:
+      status, text = await self._request_with_retry(params)
+    except BaseException:
+      self.release(limiters)
+      raise
+
+    # rejections by the quota still report what is left
+    data = self.load_json(text) if status in (200, 429) else None
+    if data is not None and 'header' in data:
+      self.reconcile(data['header'])
+
+    if self.verify_http_status(status, limiters):
+      if data is not None and self.verify_header_status(data, limiters):
+        return data
+
+  def verify_http_status(self, status, limiters):
+    if status == 429:
+      # SauceNAO counted the request and says the quota is gone, keep the tokens spent
+      print('HTTP Status 429, quota exhausted')
+      return False
+    elif status != 200:
+      self.release(limiters)
+      print('HTTP Status', str(status))
       return False
     else:
       return True
 
-  def verify_header_status(self, data, threads):
+  def verify_header_status(self, data, limiters):
     header = data['header']
     if header['status'] != 0:
-      [thread.cancel() for thread in threads]
+      self.release(limiters)
       print('Header Status', str(header['status']))
       return False
     else:
       return True
 
-  def load_json(self, result):
+  def load_json(self, text):
     try:
-      data = json.loads(result.text)
+      data = json.loads(text)
       return data
     except ValueError:
       print('Specified file does not seem to be an image.')
-
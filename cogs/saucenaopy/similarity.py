@@ -0,0 +1,131 @@
+import random
+import sys
+import time
+from io import BytesIO
+
+from PIL import Image
+
+
+def dhash(content, size=8):
+  """Difference hash of an image
+
+  The image is shrunk to (size + 1) x size grayscale pixels and every bit
+  tells if a pixel is brighter than its right neighbour, so resizing and
+  recompressing the image barely changes the hash.
+
+  :param content: image file as bytes
+  :return: int with size * size bits, None if the content isn't an image
+  """
+  try:
+    image = Image.open(BytesIO(content)).convert('L').resize((size + 1, size), Image.BILINEAR)
+  except Exception:
+    # broken or hostile files fail in all kinds of ways inside the decoders, DecompressionBombError included
+    return None
+
+  pixels = list(image.getdata())
+  bits = 0
+
+  for row in range(size):
+    for col in range(size):
+      index = row * (size + 1) + col
+      bits = (bits << 1) | (pixels[index] > pixels[index + 1])
+
+  return bits
+
+
+def hamming(a, b):
+  return bin(a ^ b).count('1')
+
+
+class HashIndex:
+  """Finds hashes within a small hamming distance of each other
+
+  Hashes are split into `bands` chunks, each with its own lookup table.
+  Two hashes differing in fewer bits than there are chunks must have
+  at least one chunk in common, so a query only compares against the
+  hashes sharing a chunk with it instead of against every hash.
+
+  :param bits: size of the hashes
+  :param bands: amount of chunks, queries support thresholds up to bands - 1
+  """
+
+  def __init__(self, bits=64, bands=8):
+    self.bands = bands
+    self.band_bits = bits // bands
+    self.mask = (1 << self.band_bits) - 1
+
+    # one table per chunk: chunk value -> hashes with that chunk
+    self.tables = [{} for _ in range(bands)]
+
+    # hash -> values stored under it
+    self.values = {}
+
+  def __len__(self):
+    return len(self.values)
+
+  def _split(self, key):
+    return [(key >> (i * self.band_bits)) & self.mask for i in range(self.bands)]
+
+  def add(self, key, value):
+    if key not in self.values:
+      self.values[key] = []
+
+      for table, chunk in zip(self.tables, self._split(key)):
+        table.setdefault(chunk, []).append(key)
+
+    self.values[key].append(value)
+
+  def query(self, key, threshold):
+    """:return: list of (distance, value) within threshold of key, closest first"""
+    if threshold >= self.bands:
+      raise ValueError('threshold has to be smaller than {}'.format(self.bands))
+
+    candidates = set()
+    for table, chunk in zip(self.tables, self._split(key)):
+      candidates.update(table.get(chunk, ()))
+
+    found = []
+    for candidate in candidates:
+      distance = hamming(key, candidate)
+
+      if distance <= threshold:
+        found.extend((distance, value) for value in self.values[candidate])
+
+    found.sort(key=lambda match: match[0])
+    return found
+
+
+def benchmark(count=100000, queries=1000, threshold=6):
+  """Prints how long queries take on an index of count random hashes, against comparing with every hash"""
+  keys = [random.getrandbits(64) for _ in range(count)]
+
+  start = time.perf_counter()
+  index = HashIndex()
+  for i, key in enumerate(keys):
+    index.add(key, i)
+  print('add      {:>10.3f} s for {} hashes'.format(time.perf_counter() - start, count))
+
+  # half of the queries are near duplicates of indexed hashes, the other half misses
+  probes = []
+  for i in range(queries):
+    key = random.choice(keys) if i % 2 else random.getrandbits(64)
+    for bit in random.sample(range(64), threshold // 2):
+      key ^= 1 << bit
+    probes.append(key)
+
+  start = time.perf_counter()
+  found = [index.query(key, threshold) for key in probes]
+  indexed = time.perf_counter() - start
+
+  start = time.perf_counter()
+  scanned = [sorted(d for d in (hamming(key, other) for other in keys) if d <= threshold) for key in probes[:100]]
+  linear = (time.perf_counter() - start) / len(scanned) * queries
+
+  assert [sorted(d for d, _ in matches) for matches in found[:100]] == scanned
+  print('query    {:>10.1f} us/op indexed, {:.1f} us/op comparing with every hash'.format(
+    indexed / queries * 1e6, linear / queries * 1e6))
+  print('found    {} of {} near duplicates'.format(sum(1 for matches in found if matches), queries // 2))
+
+
+if __name__ == '__main__':
+  benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
@@ -17,6 +17,8 @@ HELP_MESSAGE = """\
  manga : Grab the latest manga releases from /r/manga
     db : Commands for editing user base
      $ : See how much money you have left
+   top : See the richest members
+  rank : See where you stand on the leaderboard
   give : Give someone money from your bank
          [example] give <amount> <@user>
     rr : Play russian roulette
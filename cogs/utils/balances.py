@@ -0,0 +1,219 @@
+"""
+Write-behind cache for the balances stored in users.db
+"""
+import asyncio
+import time
+
+from . import userbase
+
+
+class BalanceCache:
+    """Keeps balances in memory and writes them back in batches
+
+    Reads are served from memory once a user has been loaded,
+    writes only change the cached value and mark the user dirty.
+    Dirty balances are written back in a single transaction every
+    flush_interval seconds, or as soon as flush_threshold users are dirty.
+
+    All mutations happen on the event loop without awaiting in between
+    the check and the update, so they are atomic with respect to each other.
+
+    That only holds within one process. When several shards share the
+    user base, write_through turns the cache off and every change becomes
+    a single transaction on the shared writer instead.
+
+    :param db: utils.database.Database holding the Users table
+    :param flush_interval: seconds between periodic flushes
+    :param flush_threshold: amount of dirty users that triggers an early flush
+    :param on_change: optional callable(discord_id, money) called after every change
+    :param write_through: don't cache, read and write users.db directly
+    """
+
+    def __init__(self, db, flush_interval=5.0, flush_threshold=100, on_change=None, write_through=False):
+        self.db = db
+        self.loop = db.loop
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.on_change = on_change
+        self.write_through = write_through
+
+        # discord id -> money
+        self.balances = {}
+        self.dirty = set()
+
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'flushes': 0,
+            'flushed_rows': 0,
+            'max_flush_size': 0,
+            'flush_time': 0.0,
+            'max_flush_time': 0.0,
+        }
+
+        self._flush_lock = asyncio.Lock()
+        self._pending_flush = None
+        self._task = None if write_through else self.loop.create_task(self._flush_task())
+
+    async def get(self, discord_id):
+        """:return: cached balance of the user, None if the user isn't in the user base"""
+        if discord_id in self.balances:
+            self.stats['hits'] += 1
+            return self.balances[discord_id]
+
+        self.stats['misses'] += 1
+        money = await self.db.run(userbase.get_money, discord_id)
+
+        if money is None or self.write_through:
+            return money
+
+        # someone else might have loaded and changed it while we were waiting
+        return self.balances.setdefault(discord_id, money)
+
+    async def _load(self, discord_id):
+        if await self.get(discord_id) is None:
+            raise ValueError('{} is not in the user base'.format(discord_id))
+
+    async def _write(self, func, discord_ids, *args):
+        """Runs a userbase function on the database and reports the balances it changed"""
+        for discord_id, money in await self.db.run(userbase.change_and_get, func, discord_ids, *args):
+            if money is None:
+                raise ValueError('{} is not in the user base'.format(discord_id))
+
+            if self.on_change is not None:
+                self.on_change(discord_id, money)
+
+    async def add(self, discord_id, amount):
+        if self.write_through:
+            await self._write(userbase.add_money, [discord_id], discord_id, amount)
+            return
+
+        await self._load(discord_id)
+
+        self.balances[discord_id] += int(amount)
+        self._mark_dirty(discord_id)
+
+    async def remove(self, discord_id, amount):
+        """Removes money, the balance never drops below 0"""
+        if self.write_through:
+            await self._write(userbase.remove_money, [discord_id], discord_id, amount)
+            return
+
+        await self._load(discord_id)
+
+        self.balances[discord_id] = max(self.balances[discord_id] - int(amount), 0)
+        self._mark_dirty(discord_id)
+
+    async def transfer(self, from_id, to_id, amount):
+        """Same contract as userbase.transfer, but against the cache"""
+        amount = int(amount)
+        if amount <= 0:
+            raise ValueError('Amount has to be positive')
+
+        ids = [i for i in (from_id, to_id) if i is not None]
+
+        if self.write_through:
+            await self._write(userbase.transfer, ids, from_id, to_id, amount)
+            return
+
+        # load both first, from here on nothing awaits until the update is done
+        for discord_id in ids:
+            await self._load(discord_id)
+
+        if from_id is not None:
+            if self.balances[from_id] < amount:
+                raise ValueError('{} does not have enough money'.format(from_id))
+
+            self.balances[from_id] -= amount
+
+        if to_id is not None:
+            self.balances[to_id] += amount
+
+        self._mark_dirty(*ids)
+
+    def _mark_dirty(self, *discord_ids):
+        self.dirty.update(discord_ids)
+
+        if self.on_change is not None:
+            for discord_id in discord_ids:
+                self.on_change(discord_id, self.balances[discord_id])
+
+        if len(self.dirty) >= self.flush_threshold and self._pending_flush is None:
+            self._pending_flush = asyncio.ensure_future(self.flush(), loop=self.loop)
+            self._pending_flush.add_done_callback(self._flush_done)
+
+    def _flush_done(self, future):
+        self._pending_flush = None
+
+        if not future.cancelled() and future.exception():
+            print('Failed to flush balances: {}'.format(future.exception()))
+
+    def _take_dirty(self):
+        rows = [(self.balances[i], int(i)) for i in self.dirty]
+        self.dirty = set()
+        return rows
+
+    def _record_flush(self, size, elapsed):
+        self.stats['flushes'] += 1
+        self.stats['flushed_rows'] += size
+        self.stats['max_flush_size'] = max(self.stats['max_flush_size'], size)
+        self.stats['flush_time'] += elapsed
+        self.stats['max_flush_time'] = max(self.stats['max_flush_time'], elapsed)
+
+    async def flush(self):
+        """Writes all dirty balances back in one transaction
+
+        :return: amount of users written
+        """
+        async with self._flush_lock:
+            if not self.dirty:
+                return 0
+
+            ids = set(self.dirty)
+            rows = self._take_dirty()
+            start = time.perf_counter()
+
+            try:
+                await self.db.run(userbase.set_balances, rows)
+            except Exception:
+                # keep them dirty so the next flush tries again
+                self.dirty.update(ids)
+                raise
+
+            self._record_flush(len(rows), time.perf_counter() - start)
+            return len(rows)
+
+    def flush_sync(self):
+        """Blocking flush for shutdown, when the event loop might not be running anymore"""
+        if not self.dirty:
+            return 0
+
+        rows = self._take_dirty()
+        start = time.perf_counter()
+
+        # the worker runs jobs in order, so this lands after any flush still in flight
+        self.db.run_sync(userbase.set_balances, rows)
+
+        self._record_flush(len(rows), time.perf_counter() - start)
+        return len(rows)
+
+    def invalidate(self):
+        """Forgets every clean balance, used after the table was changed behind our back"""
+        self.balances = {i: self.balances[i] for i in self.dirty}
+
+    async def _flush_task(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            try:
+                await self.flush()
+            except Exception as e:
+                print('Failed to flush balances: {}'.format(e))
+
+    def close(self):
+        """Stops the periodic flush and writes everything that is left"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        self.flush_sync()
@@ -0,0 +1,153 @@
+"""
+Sqlite access that doesn't block the event loop
+"""
+import asyncio
+import functools
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Listener
+
+
+def _close(con):
+    con.close()
+
+
+def _remote_call(con, func, *args):
+    """Runs func on the other end of a DatabaseServer connection"""
+    con.send((func, args))
+    ok, value = con.recv()
+
+    if not ok:
+        raise value
+    return value
+
+
+class Database:
+    """Owns a sqlite connection living on one dedicated worker thread
+
+    Every query is shipped to the worker, so a slow query or fsync
+    only stalls the worker instead of every guild's commands.
+    Functions given to run() are called with the connection as first argument,
+    keep them at module level so they don't drag any state along.
+
+    :param path: path to the sqlite database file
+    :param loop: event loop the awaitable api belongs to
+    """
+
+    def __init__(self, path, loop=None):
+        self.path = path
+        self.loop = loop or asyncio.get_event_loop()
+
+        # a single worker keeps all access to the connection serialized
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.con = self._executor.submit(sqlite3.connect, path).result()
+
+    async def run(self, func, *args):
+        """Runs func(con, *args) on the worker thread
+
+        :return: whatever func returns
+        """
+        call = functools.partial(func, self.con, *args)
+        return await self.loop.run_in_executor(self._executor, call)
+
+    def run_sync(self, func, *args):
+        """Blocking version of run, for places without an event loop like unloading"""
+        return self._executor.submit(func, self.con, *args).result()
+
+    def close(self):
+        """Waits for pending work and closes the connection"""
+        if self._executor is None:
+            return
+
+        self.run_sync(_close)
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+
+class RemoteDatabase(Database):
+    """Database whose connection lives in another process, behind a DatabaseServer
+
+    Used by shards so they all go through a single writer.
+    Functions are pickled by reference, which is one more reason
+    to keep them at module level.
+
+    :param address: (host, port) of the DatabaseServer
+    :param authkey: bytes the server was started with
+    :param loop: event loop the awaitable api belongs to
+    """
+
+    def __init__(self, address, authkey, loop=None):
+        self.path = address
+        self.loop = loop or asyncio.get_event_loop()
+
+        # a single worker, so requests and answers never interleave on the connection
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self.con = self._executor.submit(Client, address, authkey=authkey).result()
+
+    async def run(self, func, *args):
+        return await super().run(_remote_call, func, *args)
+
+    def run_sync(self, func, *args):
+        return super().run_sync(_remote_call, func, *args)
+
+    def close(self):
+        """Closes the connection to the server, the database itself stays open"""
+        if self._executor is None:
+            return
+
+        self._executor.submit(self.con.close).result()
+        self._executor.shutdown(wait=True)
+        self._executor = None
+
+
+class DatabaseServer:
+    """Serves a Database to RemoteDatabases in other processes
+
+    Every client gets a thread, but all of them hand their calls to the
+    single worker of the Database, so writes stay serialized across processes.
+
+    :param db: Database to serve
+    :param address: (host, port) to listen on, port 0 picks a free one
+    :param authkey: bytes clients have to know to connect
+    """
+
+    def __init__(self, db, address, authkey):
+        self.db = db
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+
+        self._thread = threading.Thread(target=self._accept, daemon=True)
+        self._thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                con = self.listener.accept()
+            except OSError:
+                # closed
+                return
+            except Exception as e:
+                # most likely a client with the wrong authkey
+                print('Refused database client: {}: {}'.format(type(e).__name__, e))
+                continue
+
+            threading.Thread(target=self._serve, args=(con,), daemon=True).start()
+
+    def _serve(self, con):
+        with con:
+            while True:
+                try:
+                    func, args = con.recv()
+                except (EOFError, OSError):
+                    return
+
+                try:
+                    answer = (True, self.db.run_sync(func, *args))
+                except Exception as e:
+                    answer = (False, e)
+
+                con.send(answer)
+
+    def close(self):
+        self.listener.close()
@@ -0,0 +1,58 @@
+"""
+In memory index of who is in the user base
+"""
+
+
+class MemberDirectory:
+    """Maps discord ids to names and back
+
+    Kept next to the Users table so membership checks and
+    name lookups don't have to go through the database.
+    Names aren't unique, so a name maps to a set of ids.
+
+    :param rows: iterable of (discord id, name) tuples to start with
+    """
+
+    def __init__(self, rows=()):
+        self.names = {}
+        self.ids = {}
+        self.load(rows)
+
+    def __contains__(self, discord_id):
+        return discord_id in self.names
+
+    def __len__(self):
+        return len(self.names)
+
+    def load(self, rows):
+        """Replaces the whole index"""
+        self.names = {}
+        self.ids = {}
+
+        for discord_id, name in rows:
+            self.add(discord_id, name)
+
+    def add(self, discord_id, name):
+        """Adds a member, or renames it if it already exists"""
+        self.remove(discord_id)
+
+        self.names[discord_id] = name
+        self.ids.setdefault(name, set()).add(discord_id)
+
+    def remove(self, discord_id):
+        name = self.names.pop(discord_id, None)
+        if name is None:
+            return
+
+        ids = self.ids[name]
+        ids.discard(discord_id)
+        if not ids:
+            del self.ids[name]
+
+    def name(self, discord_id):
+        """:return: name of the member, None if not in the user base"""
+        return self.names.get(discord_id)
+
+    def find(self, name):
+        """:return: set of ids of members with the given name"""
+        return set(self.ids.get(name, ()))
@@ -0,0 +1,62 @@
+"""
+Ranking of the user base by money
+"""
+from bisect import bisect_left, insort
+
+
+class Leaderboard:
+    """Keeps every member sorted by money
+
+    The ranking is a sorted list of (-money, discord id) that is updated
+    one entry at a time whenever a balance changes, so top and rank
+    lookups never have to sort the whole user base.
+
+    :param rows: iterable of (discord id, money) tuples to start with
+    """
+
+    def __init__(self, rows=()):
+        self.money = {}
+        self._ranking = []
+        self.load(rows)
+
+    def __len__(self):
+        return len(self._ranking)
+
+    def load(self, rows):
+        """Replaces the whole ranking"""
+        self.money = dict(rows)
+        self._ranking = sorted((-money, discord_id) for discord_id, money in self.money.items())
+
+    def update(self, discord_id, money):
+        """Moves a member to the position belonging to its new balance"""
+        old = self.money.get(discord_id)
+        if old == money:
+            return
+
+        if old is not None:
+            index = bisect_left(self._ranking, (-old, discord_id))
+            del self._ranking[index]
+
+        self.money[discord_id] = money
+        insort(self._ranking, (-money, discord_id))
+
+    def remove(self, discord_id):
+        old = self.money.pop(discord_id, None)
+        if old is not None:
+            del self._ranking[bisect_left(self._ranking, (-old, discord_id))]
+
+    def top(self, n):
+        """:return: list of (discord id, money) of the n richest members"""
+        return [(discord_id, -money) for money, discord_id in self._ranking[:n]]
+
+    def rank(self, discord_id):
+        """Members with the same amount of money share a rank
+
+        :return: 1 based rank, None if the member isn't ranked
+        """
+        money = self.money.get(discord_id)
+        if money is None:
+            return None
+
+        # everyone in front of the first entry with this amount has more money
+        return bisect_left(self._ranking, (-money,)) + 1
@@ -0,0 +1,177 @@
+"""
+Counters and latency histograms of the bot, exportable in the Prometheus text format
+"""
+from bisect import bisect_left
+import os
+import time
+
+
+# upper bounds in seconds, closer together where most commands end up
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.15, 0.25, 0.35, 0.5,
+           0.75, 1.0, 1.5, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram:
+    """Latency histogram with fixed buckets
+
+    Memory stays the same however many samples are observed, quantiles
+    are estimated by interpolating within the bucket they fall in.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+
+        # the last count is for samples above the last bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """:return: estimated q quantile in seconds, 0 without samples"""
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - seen) / count
+
+            seen += count
+
+        return self.max
+
+    def cumulative(self):
+        """:return: list of (upper bound, amount of samples at most that long) as Prometheus wants them"""
+        total = 0
+        pairs = []
+
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            pairs.append((bound, total))
+
+        pairs.append(('+Inf', self.count))
+        return pairs
+
+
+class CommandStats:
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """Per command call counts, error counts and latency,
+    and the time spent waiting on requests to discord
+    """
+
+    def __init__(self):
+        # qualified command name -> CommandStats
+        self.commands = {}
+
+        # discord api method -> Histogram
+        self.requests = {}
+
+    def _command(self, name):
+        stats = self.commands.get(name)
+        if stats is None:
+            stats = self.commands[name] = CommandStats()
+        return stats
+
+    def observe_command(self, name, seconds):
+        stats = self._command(name)
+        stats.calls += 1
+        stats.latency.observe(seconds)
+
+    def error(self, name):
+        self._command(name).errors += 1
+
+    def command_event(self, event, command, ctx):
+        """Times commands through the events commands.Bot.process_commands dispatches
+
+        'command' is dispatched right before a command runs, then either
+        'command_completion' or 'command_error' once it is done.
+
+        :param event: name of the event
+        :param command: the command for 'command' and 'command_completion', the error for 'command_error'
+        :param ctx: commands.Context of the command
+        """
+        if event == 'command':
+            ctx.metrics_start = time.perf_counter()
+            return
+
+        # commands that were never found didn't start
+        start = getattr(ctx, 'metrics_start', None)
+        if start is None:
+            return
+
+        name = (ctx.invoked_subcommand or ctx.command).qualified_name
+        self.observe_command(name, time.perf_counter() - start)
+
+        if event == 'command_error':
+            self.error(name)
+
+    def observe_request(self, method, seconds):
+        histogram = self.requests.get(method)
+        if histogram is None:
+            histogram = self.requests[method] = Histogram()
+        histogram.observe(seconds)
+
+    def _histogram_lines(self, metric, label, histograms):
+        lines = ['# TYPE {} histogram'.format(metric)]
+
+        for value, histogram in sorted(histograms):
+            value = escape(value)
+
+            for bound, count in histogram.cumulative():
+                lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(metric, label, value, bound, count))
+
+            lines.append('{}_sum{{{}="{}"}} {}'.format(metric, label, value, histogram.sum))
+            lines.append('{}_count{{{}="{}"}} {}'.format(metric, label, value, histogram.count))
+
+        return lines
+
+    def prometheus(self):
+        """:return: all metrics in the Prometheus text exposition format"""
+        commands = sorted(self.commands.items())
+        lines = ['# HELP bot_command_calls_total Commands invoked',
+                 '# TYPE bot_command_calls_total counter']
+        lines.extend('bot_command_calls_total{{command="{}"}} {}'.format(escape(name), stats.calls)
+                     for name, stats in commands)
+
+        lines.extend(['# HELP bot_command_errors_total Commands that raised an error',
+                      '# TYPE bot_command_errors_total counter'])
+        lines.extend('bot_command_errors_total{{command="{}"}} {}'.format(escape(name), stats.errors)
+                     for name, stats in commands)
+
+        lines.append('# HELP bot_command_latency_seconds Time from invoking a command until it finished')
+        lines.extend(self._histogram_lines('bot_command_latency_seconds', 'command',
+                                           [(name, stats.latency) for name, stats in commands]))
+
+        lines.append('# HELP bot_discord_request_seconds Time spent waiting on discord api requests')
+        lines.extend(self._histogram_lines('bot_discord_request_seconds', 'method', self.requests.items()))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """Writes the Prometheus text to path, replacing it in one go so readers never see half a file"""
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(temp_path, path)
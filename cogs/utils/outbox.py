@@ -0,0 +1,143 @@
+"""
+Send queue merging bursts of small messages to the same destination
+"""
+import asyncio
+import sys
+import time
+from collections import deque
+
+
+# longest message discord accepts
+MESSAGE_LIMIT = 2000
+
+
+class Destination:
+
+    def __init__(self, destination):
+        self.destination = destination
+
+        # (content, future) waiting to be sent
+        self.pending = deque()
+
+        # times of the latest sends, for the per channel rate limit
+        self.sent = deque()
+        self.task = None
+
+
+class Outbox:
+    """Queues messages per destination and sends them merged
+
+    Messages to the same channel or user arriving within `window` seconds
+    are joined with newlines into as few messages of at most 2000
+    characters as possible. Sends stay within discord's limit of `rate`
+    messages per `per` seconds per channel; while a destination has to
+    wait, new messages keep piling up and get merged as well.
+    Only plain text is merged, send embeds and files directly.
+
+    :param bot: discord bot to send with
+    """
+
+    window = 0.25
+    rate = 5
+    per = 5.0
+
+    def __init__(self, bot):
+        self.bot = bot
+
+        # destination id -> Destination
+        self.destinations = {}
+
+        self.stats = {'queued': 0, 'sent': 0, 'failed': 0}
+
+    def send(self, destination, content):
+        """Queues content for destination
+
+        The returned future can be awaited by callers that need the message,
+        others can leave it be, failed sends are printed either way.
+        Order per destination is kept.
+
+        :param destination: discord.Channel, discord.User or anything else send_message accepts
+        :return: future resolving to the discord.Message content ended up in
+        """
+        queue = self.destinations.get(destination.id)
+        if queue is None:
+            queue = self.destinations[destination.id] = Destination(destination)
+
+        future = self.bot.loop.create_future()
+        future.add_done_callback(self._retrieve_error)
+        queue.pending.append((str(content), future))
+        self.stats['queued'] += 1
+
+        if queue.task is None:
+            queue.task = self.bot.loop.create_task(self._drain(queue))
+
+        return future
+
+    @staticmethod
+    def _retrieve_error(future):
+        # _drain prints the error once per batch, this only keeps asyncio
+        # from warning about every future nobody awaited
+        if not future.cancelled():
+            future.exception()
+
+    async def _wait_for_rate_limit(self, queue):
+        now = time.monotonic()
+        while queue.sent and queue.sent[0] <= now - self.per:
+            queue.sent.popleft()
+
+        if len(queue.sent) >= self.rate:
+            await asyncio.sleep(queue.sent[0] + self.per - now)
+
+    def _take_batch(self, queue):
+        """Takes the pending messages that fit in one message, at least one"""
+        batch = [queue.pending.popleft()]
+        length = len(batch[0][0])
+
+        while queue.pending and length + 1 + len(queue.pending[0][0]) <= MESSAGE_LIMIT:
+            batch.append(queue.pending.popleft())
+            length += 1 + len(batch[-1][0])
+
+        return batch
+
+    async def _drain(self, queue):
+        try:
+            while queue.pending:
+                # give the rest of the burst a moment to arrive
+                await asyncio.sleep(self.window)
+                await self._wait_for_rate_limit(queue)
+
+                batch = self._take_batch(queue)
+                queue.sent.append(time.monotonic())
+
+                try:
+                    message = await self.bot.send_message(queue.destination, '\n'.join(c for c, _ in batch))
+                except Exception as e:
+                    self.stats['failed'] += 1
+                    print('Failed to send {} messages to {}: {}: {}'.format(
+                        len(batch), queue.destination.id, type(e).__name__, e), file=sys.stderr)
+
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    self.stats['sent'] += 1
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(message)
+        finally:
+            queue.task = None
+
+            # forget idle destinations, there is one for every user ever sent a DM
+            self._forget(queue)
+
+    def _forget(self, queue):
+        """Drops an idle destination, once its sends no longer count against the rate limit"""
+        # sends since then keep it around, their own drain forgets it again
+        if queue.task is not None or queue.pending or self.destinations.get(queue.destination.id) is not queue:
+            return
+
+        delay = queue.sent[-1] + self.per - time.monotonic() if queue.sent else 0
+        if delay > 0:
+            self.bot.loop.call_later(delay, self._forget, queue)
+        else:
+            del self.destinations[queue.destination.id]
@@ -0,0 +1,304 @@
+"""
+Schema and queries for the user base stored in users.db
+
+All functions here run on the database worker thread and receive
+the sqlite connection as first argument, see utils.database.Database.
+Statements are kept as constants with ? placeholders, sqlite3 caches
+the compiled statement per connection so they are only parsed once.
+
+Running this module migrates an existing database in place:
+    python -m cogs.utils.userbase users.db
+
+or times the common queries on a generated in-memory user base:
+    python -m cogs.utils.userbase --bench 100000
+"""
+import random
+import sqlite3
+import sys
+import time
+
+SCHEMA_VERSION = 1
+
+COLUMNS = ('id', 'name', 'money', 'daily')
+
+CREATE_USERS = """\
+CREATE TABLE IF NOT EXISTS Users (
+    id    INTEGER PRIMARY KEY,
+    name  TEXT NOT NULL,
+    money INTEGER NOT NULL DEFAULT 0,
+    daily TEXT
+)"""
+
+CREATE_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_users_name ON Users (name)',
+)
+
+SELECT_USER = 'SELECT id, name, money, daily FROM Users WHERE id = ?'
+SELECT_MONEY = 'SELECT money FROM Users WHERE id = ?'
+SELECT_DIRECTORY = 'SELECT id, name FROM Users'
+SELECT_BALANCES = 'SELECT id, money FROM Users'
+INSERT_USER = 'INSERT INTO Users (id, name) VALUES (?, ?)'
+INSERT_USER_OR_IGNORE = 'INSERT OR IGNORE INTO Users (id, name) VALUES (?, ?)'
+RENAME_USER = 'UPDATE Users SET name = ? WHERE id = ? AND name <> ?'
+SET_NAME = 'UPDATE Users SET name = ? WHERE id = ?'
+ADD_MONEY = 'UPDATE Users SET money = money + ? WHERE id = ?'
+REMOVE_MONEY = 'UPDATE Users SET money = MAX(money - ?, 0) WHERE id = ?'
+TAKE_MONEY = 'UPDATE Users SET money = money - ? WHERE id = ? AND money >= ?'
+SET_MONEY = 'UPDATE Users SET money = ? WHERE id = ?'
+
+# only whitelisted columns ever end up in the statement text
+SELECT_BY_COLUMN = {c: 'SELECT id, name, money, daily FROM Users WHERE {} = ?'.format(c) for c in COLUMNS}
+
+
+def _to_row(row):
+    """Converts a Users row into the format discord.py uses, ids are strings there"""
+    return (str(row[0]),) + tuple(row[1:])
+
+
+def create_schema(con):
+    """Creates the Users table, migrating a name keyed table if there is one"""
+    version = con.execute('PRAGMA user_version').fetchone()[0]
+    exists = con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='Users'").fetchone()
+
+    if exists and version < 1:
+        migrate_v1(con)
+
+    con.execute(CREATE_USERS)
+    for statement in CREATE_INDEXES:
+        con.execute(statement)
+
+    con.execute('PRAGMA user_version = {:d}'.format(SCHEMA_VERSION))
+    con.commit()
+
+
+def enable_wal(con):
+    """Switches to write-ahead logging, commits no longer block readers
+    and only need a full fsync on checkpoints"""
+    con.execute('PRAGMA journal_mode = WAL')
+    con.execute('PRAGMA synchronous = NORMAL')
+
+
+def migrate_v1(con):
+    """Rebuilds a legacy Users table into the id keyed layout
+
+    Rows without an id are dropped, if an id shows up more than once
+    the first row is kept. Runs in a single transaction.
+    """
+    legacy = {r[1].lower() for r in con.execute('PRAGMA table_info(Users)')}
+    daily = 'daily' if 'daily' in legacy else 'NULL'
+
+    # manage the transaction by hand, the sqlite3 module commits implicitly around DDL
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+
+    try:
+        con.execute('BEGIN')
+        con.execute('ALTER TABLE Users RENAME TO Users_v0')
+        con.execute(CREATE_USERS)
+        con.execute('INSERT OR IGNORE INTO Users (id, name, money, daily) '
+                    "SELECT CAST(id AS INTEGER), COALESCE(name, ''), COALESCE(money, 0), {} "
+                    'FROM Users_v0 WHERE id IS NOT NULL ORDER BY rowid'.format(daily))
+        con.execute('DROP TABLE Users_v0')
+        con.execute('COMMIT')
+    except sqlite3.Error:
+        con.execute('ROLLBACK')
+        raise
+    finally:
+        con.isolation_level = isolation_level
+
+
+def get_user(con, discord_id):
+    row = con.execute(SELECT_USER, (int(discord_id),)).fetchone()
+    return _to_row(row) if row else None
+
+
+def get_rows(con, column, value):
+    if column == 'id':
+        value = int(value)
+
+    return [_to_row(r) for r in con.execute(SELECT_BY_COLUMN[column], (value,))]
+
+
+def get_directory(con):
+    """:return: list of (discord id, name) of everyone in the user base"""
+    return [(str(r[0]), r[1]) for r in con.execute(SELECT_DIRECTORY)]
+
+
+def get_money(con, discord_id):
+    """:return: money of the user, None if the user doesn't exist"""
+    row = con.execute(SELECT_MONEY, (int(discord_id),)).fetchone()
+    return row[0] if row else None
+
+
+def add_member(con, discord_id, name):
+    """Add a new member to the user base
+
+    :param discord_id: discord user.id
+    :param name: discord user name
+
+    :return: raises exception on failure
+    """
+    try:
+        con.execute(INSERT_USER, (int(discord_id), name))
+        con.commit()
+
+    except sqlite3.IntegrityError:
+        # rollback changes if error occurs
+        con.rollback()
+        raise
+
+
+def add_members(con, members):
+    """Bulk inserts members in one transaction, existing members only get their name updated
+
+    :param members: list of (discord id, name) tuples
+    :return: tuple of (amount inserted, amount renamed)
+    """
+    rows = [(int(discord_id), name) for discord_id, name in members]
+
+    try:
+        before = con.total_changes
+        con.executemany(INSERT_USER_OR_IGNORE, rows)
+        inserted = con.total_changes - before
+
+        before = con.total_changes
+        con.executemany(RENAME_USER, [(name, discord_id, name) for discord_id, name in rows])
+        renamed = con.total_changes - before
+
+        con.commit()
+
+    except sqlite3.Error:
+        con.rollback()
+        raise
+
+    return inserted, renamed
+
+
+def get_balances(con):
+    """:return: list of (discord id, money) of everyone in the user base"""
+    return [(str(r[0]), r[1]) for r in con.execute(SELECT_BALANCES)]
+
+
+def rename_member(con, discord_id, name):
+    con.execute(SET_NAME, (name, int(discord_id)))
+    con.commit()
+
+
+def add_money(con, discord_id, amount):
+    con.execute(ADD_MONEY, (int(amount), int(discord_id)))
+    con.commit()
+
+
+def remove_money(con, discord_id, amount):
+    """Removes money, the balance never drops below 0"""
+    con.execute(REMOVE_MONEY, (int(amount), int(discord_id)))
+    con.commit()
+
+
+def set_balances(con, rows):
+    """Writes a batch of balances in one transaction
+
+    :param rows: iterable of (money, discord id) tuples
+    """
+    try:
+        con.executemany(SET_MONEY, rows)
+        con.commit()
+    except sqlite3.Error:
+        con.rollback()
+        raise
+
+
+def transfer(con, from_id, to_id, amount):
+    """Moves money between two users in a single transaction
+
+    The balance check is part of the UPDATE, so it can't race with other writes.
+
+    :param from_id: discord id to take from, None to create the money
+    :param to_id: discord id to give to, None to destroy the money
+    :param amount: positive amount of money to move
+
+    :return: raises ValueError and rolls back if anything doesn't add up
+    """
+    amount = int(amount)
+    if amount <= 0:
+        raise ValueError('Amount has to be positive')
+
+    try:
+        if from_id is not None:
+            cur = con.execute(TAKE_MONEY, (amount, int(from_id), amount))
+            if cur.rowcount != 1:
+                raise ValueError('{} does not have enough money'.format(from_id))
+
+        if to_id is not None:
+            cur = con.execute(ADD_MONEY, (amount, int(to_id)))
+            if cur.rowcount != 1:
+                raise ValueError('{} is not in the user base'.format(to_id))
+
+        con.commit()
+
+    except (ValueError, sqlite3.Error):
+        con.rollback()
+        raise
+
+
+def change_and_get(con, func, discord_ids, *args):
+    """Runs func(con, *args) and reads back the balances it changed
+
+    :return: list of (discord id, money) for discord_ids, money is None for unknown users
+    """
+    func(con, *args)
+    return [(discord_id, get_money(con, discord_id)) for discord_id in discord_ids]
+
+
+def execute(con, cmd):
+    try:
+        con.execute(cmd)
+        con.commit()
+    except sqlite3.Error:
+        # if error occurs revert changes
+        con.rollback()
+        raise
+
+
+def benchmark(rows=100000, repeat=10000):
+    """Prints how long the common queries take on an in-memory user base of rows users"""
+    con = sqlite3.connect(':memory:')
+    create_schema(con)
+
+    ids = random.sample(range(10 ** 17, 10 ** 18), rows)
+    members = [(discord_id, 'user{}'.format(i)) for i, discord_id in enumerate(ids)]
+
+    def timed(name, func, times=1):
+        start = time.perf_counter()
+        for _ in range(times):
+            func()
+        elapsed = time.perf_counter() - start
+        print('{:<24} {:>10.1f} us/op {:>10.3f} s total ({} ops)'.format(name, elapsed / times * 1e6, elapsed, times))
+
+    timed('add_members', lambda: add_members(con, members))
+    add_money(con, ids[0], rows * 10)
+
+    timed('get_user', lambda: get_user(con, random.choice(ids)), repeat)
+    timed('get_money', lambda: get_money(con, random.choice(ids)), repeat)
+    timed('get_rows by name', lambda: get_rows(con, 'name', random.choice(members)[1]), repeat)
+    timed('transfer', lambda: transfer(con, ids[0], random.choice(ids), 1), repeat)
+    timed('get_directory', lambda: get_directory(con), 10)
+    timed('get_balances', lambda: get_balances(con), 10)
+    timed('add_members (existing)', lambda: add_members(con, members))
+
+    con.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--bench':
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+        sys.exit()
+
+    path = sys.argv[1] if len(sys.argv) > 1 else 'users.db'
+    connection = sqlite3.connect(path)
+
+    create_schema(connection)
+    count = connection.execute('SELECT COUNT(*) FROM Users').fetchone()[0]
+    print('Migrated {} to schema version {} ({} users)'.format(path, SCHEMA_VERSION, count))
+
+    connection.close()
@@ -0,0 +1,223 @@
+"""
+Error reporting through a discord webhook
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+import traceback
+import urllib.request
+from collections import OrderedDict
+
+import aiohttp
+
+
+# frames in these files are where the bot's own code ends
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# longest message discord accepts
+MESSAGE_LIMIT = 2000
+
+
+def post_discord(name, content, url, timeout=10):
+    """Posts a message to a webhook and waits for it, for when there is no event loop anymore
+
+    :param name: name the message is posted under
+    :param content: text of the message, cut off at 2000 characters
+    :param url: webhook url
+    :return: status of the response, or the error if posting failed
+    """
+    payload = json.dumps({'username': name, 'content': content[:MESSAGE_LIMIT]}).encode()
+    request = urllib.request.Request(url, data=payload, headers={'Content-Type': 'application/json'})
+
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status
+    except Exception as e:
+        return '{}: {}'.format(type(e).__name__, e)
+
+
+def site(exception):
+    """:return: file:line in function of the innermost frame of the bot's own code the exception passed"""
+    frames = traceback.extract_tb(exception.__traceback__)
+    if not frames:
+        return 'unknown'
+
+    own = [frame for frame in frames if frame[0].startswith(PROJECT_DIR)]
+    filename, lineno, function, _ = (own or frames)[-1]
+
+    return '{}:{} in {}'.format(os.path.relpath(filename, PROJECT_DIR), lineno, function)
+
+
+def fingerprint(exception):
+    """Errors with the same type raised at the same place count as the same error
+
+    :return: tuple of (type name, site)
+    """
+    # commands wrap whatever the command raised
+    exception = getattr(exception, 'original', exception)
+    return type(exception).__name__, site(exception)
+
+
+class Report:
+
+    def __init__(self, exception, context):
+        self.count = 0
+        self.first = time.time()
+        self.message = str(exception)
+        self.context = context
+        self.traceback = ''.join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+
+
+class ErrorReporter:
+    """Collects errors and posts them to a webhook as a periodic digest
+
+    Errors are grouped by fingerprint, a storm of the same error ends up as
+    one line with a count instead of one post each. Only the first
+    occurrence in a digest window prints its traceback to stderr,
+    repeats are only counted.
+    Digests go out at most every `interval` seconds over one pooled session,
+    listing the `digest_size` most frequent errors.
+
+    Replies to users are throttled separately, see should_reply.
+
+    :param url: webhook url, None to only print
+    :param loop: event loop to post from
+    :param name: name the digests are posted under
+    """
+
+    interval = 60
+    digest_size = 10
+    timeout = 10
+
+    # seconds between error replies in one channel
+    reply_interval = 10
+
+    def __init__(self, url=None, loop=None, name='Waifu bot notifier'):
+        self.url = url
+        self.loop = loop or asyncio.get_event_loop()
+        self.name = name
+
+        # fingerprint -> Report of the current digest window
+        self.reports = OrderedDict()
+
+        # channel id -> time of the last error reply
+        self._replied = {}
+
+        self.stats = {'reported': 0, 'digests': 0, 'failed_digests': 0, 'throttled_replies': 0}
+
+        self._session = None
+        self._task = self.loop.create_task(self._digest_task())
+
+    def report(self, exception, context=''):
+        """Records an error, cheap enough to call from every error handler"""
+        self.stats['reported'] += 1
+        key = fingerprint(exception)
+
+        report = self.reports.get(key)
+        if report is None:
+            report = self.reports[key] = Report(getattr(exception, 'original', exception), context)
+
+            print('[{}] {}'.format(time.strftime('%H:%M:%S'), context), file=sys.stderr)
+            print(report.traceback, file=sys.stderr, end='')
+
+        report.count += 1
+
+        # repeats only show up at 10, 100, 1000.. occurrences
+        if report.count > 1 and str(report.count).rstrip('0') == '1':
+            print('{}: {} at {} (x{})'.format(key[0], report.message, key[1], report.count), file=sys.stderr)
+
+    def should_reply(self, channel_id):
+        """:return: False if the channel got an error reply less than reply_interval seconds ago"""
+        now = time.monotonic()
+
+        if now - self._replied.get(channel_id, -self.reply_interval) < self.reply_interval:
+            self.stats['throttled_replies'] += 1
+            return False
+
+        # keep the dict from growing with every channel ever replied to
+        if len(self._replied) > 1000:
+            self._replied = {c: t for c, t in self._replied.items() if now - t < self.reply_interval}
+
+        self._replied[channel_id] = now
+        return True
+
+    def digest(self):
+        """Takes the errors collected so far
+
+        :return: digest message, None if there were no errors
+        """
+        if not self.reports:
+            return None
+
+        reports, self.reports = self.reports, OrderedDict()
+        ranked = sorted(reports.items(), key=lambda item: -item[1].count)
+        total = sum(report.count for report in reports.values())
+
+        since = time.strftime('%H:%M:%S', time.localtime(min(r.first for r in reports.values())))
+        lines = ['**{} errors, {} different, since {}**'.format(total, len(reports), since)]
+
+        for (name, where), report in ranked[:self.digest_size]:
+            line = '`{}` x{} at {}: {}'.format(name, report.count, where, report.message[:200])
+            if report.context:
+                line += ' ({})'.format(report.context[:100])
+            lines.append(line)
+
+        if len(ranked) > self.digest_size:
+            lines.append('and {} more'.format(len(ranked) - self.digest_size))
+
+        content = '\n'.join(lines)
+
+        # the traceback of the most frequent error, if there is room for it
+        room = MESSAGE_LIMIT - len(content) - len('\n```py\n\n```')
+        first = ranked[0][1].traceback
+        if room > 200:
+            content += '\n```py\n{}\n```'.format(first[-room:])
+
+        return content[:MESSAGE_LIMIT]
+
+    async def post(self, content):
+        """Posts a message to the webhook over the pooled session"""
+        if self.url is None:
+            return
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession(loop=self.loop)
+
+        payload = json.dumps({'username': self.name, 'content': content})
+        request = self._session.post(self.url, data=payload, headers={'Content-Type': 'application/json'})
+
+        response = await asyncio.wait_for(request, self.timeout)
+        try:
+            if response.status >= 400:
+                raise aiohttp.ClientError('webhook answered {}'.format(response.status))
+        finally:
+            response.release()
+
+    async def send_digest(self):
+        content = self.digest()
+        if content is None:
+            return
+
+        try:
+            await self.post(content)
+            self.stats['digests'] += 1
+        except Exception as e:
+            # not reported as an error itself, that could feed on itself
+            self.stats['failed_digests'] += 1
+            print('Failed to post error digest: {}: {}'.format(type(e).__name__, e), file=sys.stderr)
+
+    async def _digest_task(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.send_digest()
+
+    async def close(self):
+        """Posts what is left and closes the session"""
+        self._task.cancel()
+        await self.send_digest()
+
+        if self._session is not None:
+            self._session.close()
+            self._session = None
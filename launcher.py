@@ -0,0 +1,242 @@
+"""
+Runs the bot as several shard processes and keeps them running
+
+Started through bot.py: python bot.py --shards 4
+"""
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from cogs.utils import userbase
+from cogs.utils.database import Database, DatabaseServer
+
+
+# every shard writes its own metrics, the launcher merges them into metrics_path
+shard_metrics_path = 'metrics-{}.prom'
+metrics_path = 'metrics.prom'
+
+
+def add_label(sample, name, value):
+    """Adds a label to a Prometheus sample line"""
+    metric, brace, rest = sample.partition('{')
+    label = '{}="{}"'.format(name, value)
+
+    if brace:
+        return '{}{{{},{}'.format(metric, label, rest)
+
+    metric, _, rest = sample.partition(' ')
+    return '{}{{{}}} {}'.format(metric, label, rest)
+
+
+def merge_metrics(texts):
+    """Merges the Prometheus text of several shards, every sample gets a shard label
+
+    :param texts: dict of shard id -> Prometheus text
+    :return: one Prometheus text with every metric family listed once
+    """
+    # family -> (comment lines, sample lines)
+    families = OrderedDict()
+
+    for shard_id, text in sorted(texts.items()):
+        family = None
+
+        for line in text.splitlines():
+            if line.startswith('#'):
+                family = line.split()[2]
+                comments, _ = families.setdefault(family, ([], []))
+                if line not in comments:
+                    comments.append(line)
+            elif line:
+                families.setdefault(family, ([], []))[1].append(add_label(line, 'shard', shard_id))
+
+    lines = []
+    for comments, samples in families.values():
+        lines.extend(comments)
+        lines.extend(samples)
+
+    return '\n'.join(lines) + '\n'
+
+
+class Shard:
+
+    def __init__(self, shard_id, delay):
+        self.shard_id = shard_id
+        self.process = None
+
+        self.started = 0.0
+        self.restarts = 0
+        self.delay = delay
+
+        # when the shard is to be started again, None while it runs
+        self.restart_at = None
+
+
+class Launcher:
+    """Starts shard_count shards of bot.py and restarts them whenever they exit
+
+    users.db is opened here once and served to the shards through a
+    DatabaseServer, so there is a single writer whatever the amount of shards.
+    Output of every shard is printed prefixed with its id, and their
+    metrics files are merged into metrics.prom with a shard label.
+
+    A shard that keeps crashing is restarted with an exponential backoff,
+    once it ran stable_after seconds the backoff starts over.
+
+    :param shard_count: amount of shards to run
+    :param script: the bot script to start the shards with
+    """
+
+    restart_delay = 5
+    max_restart_delay = 300
+    stable_after = 60
+
+    # discord allows one identify every 5 seconds
+    identify_interval = 5
+
+    metrics_interval = 60
+    stop_timeout = 30
+
+    def __init__(self, shard_count, script='bot.py'):
+        self.shard_count = shard_count
+        self.script = script
+        self.shards = [Shard(i, self.restart_delay) for i in range(shard_count)]
+
+        self._print_lock = threading.Lock()
+
+        self.db = Database('users.db')
+        self.db.run_sync(userbase.enable_wal)
+        self.db.run_sync(userbase.create_schema)
+
+        self.authkey = os.urandom(32)
+        self.server = DatabaseServer(self.db, ('localhost', 0), self.authkey)
+
+    def log(self, *args):
+        with self._print_lock:
+            print('[launcher]', *args, flush=True)
+
+    def _start(self, shard):
+        host, port = self.server.address
+        command = [sys.executable, '-u', self.script,
+                   '--shard-id', str(shard.shard_id),
+                   '--shard-count', str(self.shard_count),
+                   '--userbase', '{}:{}'.format(host, port)]
+
+        # the authkey goes through the environment so it doesn't show up in ps
+        env = dict(os.environ, USERBASE_AUTHKEY=self.authkey.hex())
+
+        # a session of its own, so ctrl-c only reaches the launcher, which then stops the shards one by one
+        shard.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env,
+                                         universal_newlines=True, start_new_session=True)
+        shard.started = time.monotonic()
+        shard.restart_at = None
+
+        threading.Thread(target=self._pipe_output, args=(shard.shard_id, shard.process), daemon=True).start()
+        self.log('Started shard', shard.shard_id, 'pid', shard.process.pid)
+
+    def _pipe_output(self, shard_id, process):
+        prefix = '[shard {}] '.format(shard_id)
+
+        for line in process.stdout:
+            with self._print_lock:
+                sys.stdout.write(prefix + line)
+                sys.stdout.flush()
+
+    def _supervise(self, shard):
+        code = shard.process.poll()
+        if code is None:
+            return
+
+        now = time.monotonic()
+
+        if shard.restart_at is None:
+            if now - shard.started > self.stable_after:
+                shard.delay = self.restart_delay
+            else:
+                shard.delay = min(shard.delay * 2, self.max_restart_delay)
+
+            shard.restart_at = now + shard.delay
+            self.log('Shard {} exited with {}, restarting in {}s'.format(shard.shard_id, code, shard.delay))
+
+        elif now >= shard.restart_at:
+            shard.restarts += 1
+            self._start(shard)
+
+    def write_metrics(self):
+        texts = {}
+        for shard in self.shards:
+            try:
+                with open(shard_metrics_path.format(shard.shard_id)) as f:
+                    texts[shard.shard_id] = f.read()
+            except OSError:
+                # the shard didn't write any yet
+                pass
+
+        lines = ['# HELP bot_shard_up Whether the shard process is running',
+                 '# TYPE bot_shard_up gauge']
+        lines.extend('bot_shard_up{{shard="{}"}} {}'.format(shard.shard_id, int(shard.process.poll() is None))
+                     for shard in self.shards)
+
+        lines.extend(['# HELP bot_shard_restarts_total Times the shard was restarted',
+                      '# TYPE bot_shard_restarts_total counter'])
+        lines.extend('bot_shard_restarts_total{{shard="{}"}} {}'.format(shard.shard_id, shard.restarts)
+                     for shard in self.shards)
+
+        temp_path = metrics_path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(merge_metrics(texts))
+                f.write('\n'.join(lines) + '\n')
+            os.replace(temp_path, metrics_path)
+        except OSError as e:
+            self.log('Failed to write metrics: {}: {}'.format(type(e).__name__, e))
+
+    def run(self):
+        try:
+            for shard in self.shards:
+                if shard.shard_id:
+                    time.sleep(self.identify_interval)
+                self._start(shard)
+
+            next_metrics = time.monotonic() + self.metrics_interval
+
+            while True:
+                time.sleep(1)
+
+                for shard in self.shards:
+                    self._supervise(shard)
+
+                if time.monotonic() >= next_metrics:
+                    next_metrics += self.metrics_interval
+                    self.write_metrics()
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Lets every shard shut down like after ctrl-c, so they write everything back"""
+        running = [shard for shard in self.shards if shard.process is not None and shard.process.poll() is None]
+
+        for shard in running:
+            self.log('Stopping shard', shard.shard_id)
+            shard.process.send_signal(signal.SIGINT)
+
+        deadline = time.monotonic() + self.stop_timeout
+        for shard in running:
+            try:
+                shard.process.wait(max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                self.log('Shard {} did not stop in time, killing it'.format(shard.shard_id))
+                shard.process.kill()
+
+        if all(shard.process is not None for shard in self.shards):
+            self.write_metrics()
+
+        self.server.close()
+        self.db.close()
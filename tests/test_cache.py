@@ -0,0 +1,18 @@
+"""
+Tests for the cache keys of SauceNAO lookups
+"""
+import pytest
+
+pytest.importorskip('PIL')
+
+from cogs.saucenaopy.cache import url_key
+
+
+def test_url_key_normalizes():
+    assert url_key(' https://www.Example.com:443/a.png?b=1&a=2 ') == 'url:https://example.com/a.png?a=2&b=1'
+    assert url_key('http://example.com:8080/a.png') == 'url:https://example.com:8080/a.png'
+
+
+def test_url_key_of_malformed_urls():
+    assert url_key(' https://a:99999/x.png ') == 'url:https://a:99999/x.png'
+    assert url_key('http://[::1/x.png') == 'url:http://[::1/x.png'
@@ -0,0 +1,89 @@
+"""
+Tests for timing commands through the events discord.py 0.16 dispatches around them
+"""
+import asyncio
+
+from cogs.utils.metrics import Metrics
+
+
+class CommandError(Exception):
+    pass
+
+
+class Command:
+
+    def __init__(self, name, callback):
+        self.name = self.qualified_name = name
+        self.callback = callback
+
+    async def invoke(self, ctx):
+        try:
+            await self.callback()
+        except Exception as e:
+            raise CommandError(e)
+
+
+class Context:
+
+    def __init__(self, command):
+        self.command = command
+        self.invoked_subcommand = None
+
+
+class FakeBot:
+    """Runs commands the way commands.Bot.process_commands does in discord.py 0.16.7"""
+
+    def __init__(self):
+        self.metrics = Metrics()
+        self.commands = {}
+
+    def dispatch(self, event, *args):
+        self.metrics.command_event(event, *args)
+
+    async def process_commands(self, name):
+        command = self.commands.get(name)
+        ctx = Context(command)
+
+        if command is None:
+            self.dispatch('command_error', CommandError('not found'), ctx)
+            return
+
+        self.dispatch('command', command, ctx)
+        try:
+            await command.invoke(ctx)
+        except CommandError as e:
+            self.dispatch('command_error', e, ctx)
+        else:
+            self.dispatch('command_completion', command, ctx)
+
+
+def test_commands_are_timed():
+    async def slow():
+        await asyncio.sleep(0.05)
+
+    async def broken():
+        raise ValueError('broken')
+
+    bot = FakeBot()
+    bot.commands = {'slow': Command('slow', slow), 'broken': Command('broken', broken)}
+
+    async def main():
+        await bot.process_commands('slow')
+        await bot.process_commands('slow')
+        await bot.process_commands('broken')
+        await bot.process_commands('missing')
+
+    asyncio.run(main())
+
+    slow_stats = bot.metrics.commands['slow']
+    assert slow_stats.calls == 2
+    assert slow_stats.latency.count == 2
+    assert slow_stats.latency.sum >= 0.1
+    assert slow_stats.errors == 0
+
+    broken_stats = bot.metrics.commands['broken']
+    assert broken_stats.calls == 1
+    assert broken_stats.latency.count == 1
+    assert broken_stats.errors == 1
+
+    assert 'missing' not in bot.metrics.commands
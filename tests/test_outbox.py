@@ -0,0 +1,99 @@
+"""
+Tests for the outbox against a fake bot
+"""
+import asyncio
+import gc
+
+from cogs.utils.outbox import Outbox
+
+
+class Destination:
+
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeBot:
+
+    def __init__(self, loop, fail=False):
+        self.loop = loop
+        self.fail = fail
+        self.sent = []
+
+    async def send_message(self, destination, content):
+        if self.fail:
+            raise RuntimeError('send failed')
+
+        self.sent.append((destination.id, content))
+        return content
+
+
+def make_outbox(fail=False):
+    outbox = Outbox(FakeBot(asyncio.get_running_loop(), fail))
+    outbox.window = 0
+    outbox.per = 0.1
+    return outbox
+
+
+def test_burst_is_merged():
+    async def main():
+        outbox = make_outbox()
+        futures = [outbox.send(Destination(1), str(i)) for i in range(3)]
+
+        assert await asyncio.gather(*futures) == ['0\n1\n2'] * 3
+        assert outbox.bot.sent == [(1, '0\n1\n2')]
+
+    asyncio.run(main())
+
+
+def test_idle_destinations_are_forgotten():
+    async def main():
+        outbox = make_outbox()
+        await outbox.send(Destination(1), 'a')
+        await asyncio.sleep(0)
+
+        # still counted against the rate limit
+        assert 1 in outbox.destinations
+
+        await asyncio.sleep(0.15)
+        assert not outbox.destinations
+
+    asyncio.run(main())
+
+
+def test_sends_after_a_drain_keep_the_destination():
+    async def main():
+        outbox = make_outbox()
+        await outbox.send(Destination(1), 'a')
+        await asyncio.sleep(0.06)
+        await outbox.send(Destination(1), 'b')
+
+        # past the window of the first send, not of the second
+        await asyncio.sleep(0.06)
+        assert 1 in outbox.destinations
+
+        await asyncio.sleep(0.1)
+        assert not outbox.destinations
+
+    asyncio.run(main())
+
+
+def test_failed_batch_is_reported_once(capsys):
+    unretrieved = []
+
+    async def main():
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: unretrieved.append(context))
+
+        outbox = make_outbox(fail=True)
+        for i in range(3):
+            outbox.send(Destination(1), str(i))
+
+        await asyncio.sleep(0.05)
+        gc.collect()
+
+        assert outbox.stats['failed'] == 1
+
+    asyncio.run(main())
+
+    assert capsys.readouterr().err.count('Failed to send') == 1
+    assert not unretrieved
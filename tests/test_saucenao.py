@@ -0,0 +1,228 @@
+"""
+Tests for the async SauceNAO client against a fake SauceNAO server on localhost
+"""
+import asyncio
+import json
+from urllib.parse import urlsplit, parse_qsl
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from cogs.saucenaopy.limiter import RateLimited
+from cogs.saucenaopy.saucenao import SauceNAO
+
+
+def header(short_remaining=19, long_remaining=299, status=0):
+    return {'status': status, 'short_remaining': short_remaining, 'short_limit': 20,
+            'long_remaining': long_remaining, 'long_limit': 300}
+
+
+def answer(url):
+    """Successful response naming the url it was asked about"""
+    return 200, {'header': header(), 'results': [{'header': {'similarity': '90'}, 'data': {'ext_urls': [url]}}]}
+
+
+class FakeSauceNAO:
+    """Minimal HTTP server playing SauceNAO
+
+    :param respond: coroutine function taking the query dict and returning (status, json body)
+    """
+
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        port = self.server.sockets[0].getsockname()[1]
+        return 'http://127.0.0.1:{}/search.php'.format(port)
+
+    async def close(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+
+            query = dict(parse_qsl(urlsplit(request_line.split()[1]).query))
+            self.requests.append(query)
+
+            status, body = await self.respond(query)
+            payload = json.dumps(body).encode()
+
+            writer.write('HTTP/1.1 {} Fake\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                         'Connection: close\r\n\r\n'.format(status, len(payload)).encode() + payload)
+            await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+
+def run(test, respond, **options):
+    """Runs test(client, server) against a fresh fake server and client"""
+
+    async def main():
+        server = FakeSauceNAO(respond)
+        url = await server.start()
+
+        options.setdefault('backoff', 0.01)
+        client = SauceNAO('key', loop=asyncio.get_running_loop(), **options)
+        client.URL = url
+
+        try:
+            return await test(client, server)
+        finally:
+            closed = client.session.close()
+            if asyncio.iscoroutine(closed):
+                await closed
+            await server.close()
+
+    return asyncio.run(main())
+
+
+def tokens(client):
+    return [round(limiter.tokens) for limiter in client.limiters]
+
+
+def test_concurrent_lookups_keep_their_own_url():
+    async def respond(query):
+        # answer out of order, so a shared url would show up in the wrong result
+        await asyncio.sleep(0.05 if query['url'].endswith('0') else 0)
+        return answer(query['url'])
+
+    async def test(client, server):
+        urls = ['https://example.com/{}.png'.format(i) for i in range(10)]
+        results = await asyncio.gather(*(client.get_sauce(url) for url in urls))
+
+        assert [r['results'][0]['data']['ext_urls'][0] for r in results] == urls
+        assert sorted(q['url'] for q in server.requests) == sorted(urls)
+        assert 'url' not in client.params
+        assert all(q['api_key'] == 'key' for q in server.requests)
+
+    run(test, respond)
+
+
+def test_timeout_returns_tokens():
+    async def respond(query):
+        await asyncio.sleep(1)
+        return answer(query['url'])
+
+    async def test(client, server):
+        before = tokens(client)
+
+        with pytest.raises(asyncio.TimeoutError):
+            await client.get_sauce('https://example.com/a.png')
+
+        assert tokens(client) == before
+        assert len(server.requests) == 2
+
+    run(test, respond, timeout=0.1, retries=1)
+
+
+def test_server_errors_are_retried():
+    statuses = [503, 500]
+
+    async def respond(query):
+        if statuses:
+            return statuses.pop(0), {}
+        return answer(query['url'])
+
+    async def test(client, server):
+        result = await client.get_sauce('https://example.com/a.png')
+
+        assert result is not None
+        assert len(server.requests) == 3
+
+    run(test, respond, retries=3)
+
+
+def test_backoff_grows_between_retries():
+    times = []
+
+    async def respond(query):
+        times.append(asyncio.get_running_loop().time())
+        return 500, {}
+
+    async def test(client, server):
+        assert await client.get_sauce('https://example.com/a.png') is None
+
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        assert len(gaps) == 2
+        assert gaps[0] >= 0.1 and gaps[1] >= 0.2
+
+    run(test, respond, retries=2, backoff=0.1)
+
+
+def test_failed_lookup_returns_tokens():
+    async def respond(query):
+        return 500, {}
+
+    async def test(client, server):
+        before = tokens(client)
+
+        assert await client.get_sauce('https://example.com/a.png') is None
+        assert tokens(client) == before
+
+    run(test, respond, retries=0)
+
+
+def test_connection_errors_are_retried_and_return_tokens():
+    import aiohttp
+
+    async def test(client, server):
+        # nothing listens there anymore
+        await server.close()
+        before = tokens(client)
+
+        with pytest.raises(aiohttp.ClientError):
+            await client.get_sauce('https://example.com/a.png')
+
+        assert tokens(client) == before
+
+    async def respond(query):
+        return answer(query['url'])
+
+    run(test, respond, retries=2)
+
+
+def test_429_keeps_tokens_and_blocks_until_reset():
+    async def respond(query):
+        return 429, {'header': header(long_remaining=0, status=-2)}
+
+    async def test(client, server):
+        short, long = client.limiters
+
+        assert await client.get_sauce('https://example.com/a.png') is None
+        assert long.reset_at is not None
+        assert client.eta() > 60 * 60
+
+        # rejected locally, the server doesn't see it
+        with pytest.raises(RateLimited):
+            await client.get_sauce('https://example.com/b.png', timeout=60)
+        assert len(server.requests) == 1
+
+    run(test, respond)
+
+
+def test_fetch_image_only_downloads_from_discord():
+    async def respond(query):
+        return answer(query['url'])
+
+    async def test(client, server):
+        for url in [client.URL, 'http://localhost/a.png', 'http://169.254.169.254/latest/meta-data/',
+                    'file:///etc/passwd', 'https://cdn.discordapp.com.example.com/a.png',
+                    'https://user@cdn.discordapp.com/a.png', 'https://cdn.discordapp.com:99999/a.png']:
+            assert not client.can_download(url)
+            assert await client.fetch_image(url) is None
+
+        assert client.can_download('https://cdn.discordapp.com/attachments/1/2/a.png')
+        assert client.can_download('https://media.discordapp.net/attachments/1/2/a.png')
+        assert not server.requests
+
+    run(test, respond)